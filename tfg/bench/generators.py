@@ -0,0 +1,132 @@
+"""Deterministic generators of synthetic profiles.
+Every generator writes a file in one of the input formats (see COLLAPSERS in
+tfg.stackcollapsers.collapsers), so the whole parsing pipeline can be benchmarked at any
+scale without real profiles.
+
+All stacks are walks down the same synthetic call graph: a frame at depth 'd' calls one
+of 'fanout' functions of depth 'd + 1'. Callees are picked with a skewed distribution, so
+like in real profiles a few paths are hot and most frames only get a few samples.
+The same parameters and seed always produce the same file.
+"""
+
+import random
+
+
+# Number of distinct functions at every depth
+MAX_NODES = 100003
+
+
+class ProfileParams(object):
+    """Shape of a synthetic profile.
+
+    samples - number of samples (perf) or stack records (other formats) to write.
+    depth - maximum stack depth. Stacks are between depth // 2 and depth frames deep.
+    fanout - number of functions every function calls.
+    name_length - length of function names. Names are padded with 'x' up to it.
+    seed - random seed.
+    """
+    def __init__(self, samples=10000, depth=32, fanout=8, name_length=32, seed=0):
+        self.samples = samples
+        self.depth = depth
+        self.fanout = fanout
+        self.name_length = name_length
+        self.seed = seed
+
+    def as_dict(self):
+        return {
+            'samples': self.samples,
+            'depth': self.depth,
+            'fanout': self.fanout,
+            'name_length': self.name_length,
+            'seed': self.seed,
+        }
+
+
+def _function_name(depth, index, name_length):
+    name = 'fn_{}_{}_'.format(depth, index)
+    return name + 'x' * (name_length - len(name))
+
+
+def generate_stacks(params):
+    """generate_stacks(params: ProfileParams) -> iterator[(list[str], int)]
+    Yield 'params.samples' (frames, count) pairs. Frames go from the root to the leaf and
+    are named 'fn_<depth>_<path hash>_xxx...', so the same path always has the same names.
+    """
+    rng = random.Random(params.seed)
+    # Names are shared between stacks, so don't build the same strings over and over
+    names = {}
+    min_depth = max(1, params.depth // 2)
+    for _ in range(params.samples):
+        frames = []
+        node = 0
+        for depth in range(rng.randint(min_depth, params.depth)):
+            # Squaring makes callees with a small index much more likely. The modulo keeps
+            # the number of distinct names bounded for deep stacks.
+            node = (node * params.fanout + int(rng.random() ** 2 * params.fanout)) % MAX_NODES
+            key = (depth, node)
+            name = names.get(key)
+            if name is None:
+                name = names[key] = _function_name(depth, node, params.name_length)
+            frames.append(name)
+        yield frames, rng.randint(1, 10)
+
+
+def write_collapsed(output_file, params):
+    """write_collapsed(output_file: file, params: ProfileParams)
+    Write stacks in the collapsed 'frame;frame;frame count' format.
+    """
+    for frames, count in generate_stacks(params):
+        output_file.write('{} {}\n'.format(';'.join(frames), count))
+
+
+def write_pyspy(output_file, params):
+    """write_pyspy(output_file: file, params: ProfileParams)
+    Write stacks in the py-spy 'function (file.py:line);... count' format.
+    """
+    for frames, count in generate_stacks(params):
+        output_file.write('{} {}\n'.format(
+            ';'.join('{} (module_{}.py:{})'.format(name, i, 10 + i) for i, name in enumerate(frames)),
+            count))
+
+
+def write_dtrace(output_file, params):
+    """write_dtrace(output_file: file, params: ProfileParams)
+    Write stacks in the DTrace ustack() format: frames from the leaf to the root followed
+    by the sample count.
+    """
+    for frames, count in generate_stacks(params):
+        output_file.write('\n')
+        for i, name in enumerate(reversed(frames)):
+            output_file.write('              libapp.so`{}+0x{:x}\n'.format(name, 16 + i))
+        output_file.write('             {}\n'.format(count))
+
+
+def write_perf(output_file, params):
+    """write_perf(output_file: file, params: ProfileParams)
+    Write samples in the 'perf script' format. Every stack is written as a single sample.
+    """
+    timestamp = 4042688.0
+    for i, (frames, _) in enumerate(generate_stacks(params)):
+        timestamp += 0.001
+        output_file.write('app {} [{:03d}] {:.6f}:     454356 cycles:\n'.format(
+            1000 + i % 16, i % 8, timestamp))
+        for j, name in enumerate(reversed(frames)):
+            output_file.write('\t{:x} {}+0x{:x} (/usr/lib/libapp.so)\n'.format(
+                0x400000 + j * 0x40, name, 16 + j))
+        output_file.write('\n')
+
+
+GENERATORS = {
+    'none': write_collapsed,
+    'dtrace': write_dtrace,
+    'perf': write_perf,
+    'pyspy': write_pyspy,
+}
+
+
+def generate_file(path, file_type, params):
+    """generate_file(path: str, file_type: str, params: ProfileParams)
+    Write a synthetic profile of the 'file_type' (a key of COLLAPSERS) to 'path'.
+    """
+    with open(path, 'w') as output_file:
+        GENERATORS[file_type](output_file, params)
@@ -0,0 +1,125 @@
+"""Benchmarks of tfg on synthetic profiles.
+'generate' writes a synthetic profile, 'run' benchmarks every stage of the pipeline on
+generated profiles and writes the results as JSON, so runs could be compared.
+"""
+
+import argparse
+import json
+import sys
+from tfg.bench.generators import GENERATORS, ProfileParams, generate_file
+from tfg.bench.runner import run
+
+
+def add_profile_arguments(parser):
+    parser.add_argument('--samples',
+                        type=int,
+                        dest='samples',
+                        default=10000,
+                        help='Number of samples (perf) or stack records (other formats)')
+    parser.add_argument('--depth',
+                        type=int,
+                        dest='depth',
+                        default=32,
+                        help='Maximum stack depth')
+    parser.add_argument('--fanout',
+                        type=int,
+                        dest='fanout',
+                        default=8,
+                        help='Number of functions every function calls')
+    parser.add_argument('--name-length',
+                        type=int,
+                        dest='name_length',
+                        default=32,
+                        help='Length of function names')
+    parser.add_argument('--seed',
+                        type=int,
+                        dest='seed',
+                        default=0,
+                        help='Random seed')
+
+
+def profile_params(args):
+    return ProfileParams(args.samples, args.depth, args.fanout, args.name_length, args.seed)
+
+
+def generate(args):
+    generate_file(args.output, args.file_type, profile_params(args))
+
+
+def benchmark(args):
+    report = run(args.file_types or sorted(GENERATORS), profile_params(args), args.repeat,
+                 not args.no_memory, args.width, args.height, args.work_dir)
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2, sort_keys=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='tfg benchmarks')
+    subparsers = parser.add_subparsers(dest='command')
+
+    generate_parser = subparsers.add_parser('generate', help='Write a synthetic profile')
+    generate_parser.add_argument('-t',
+                                 '--type',
+                                 type=str,
+                                 dest='file_type',
+                                 default='none',
+                                 choices=sorted(GENERATORS),
+                                 help='Profile file type')
+    generate_parser.add_argument('output', type=str, help='Output file')
+    add_profile_arguments(generate_parser)
+    generate_parser.set_defaults(func=generate)
+
+    run_parser = subparsers.add_parser('run', help='Benchmark tfg on synthetic profiles')
+    run_parser.add_argument('-t',
+                            '--type',
+                            type=str,
+                            dest='file_types',
+                            action='append',
+                            choices=sorted(GENERATORS),
+                            help='Profile file type to benchmark. Could be repeated (default: all)')
+    run_parser.add_argument('-o',
+                            '--output',
+                            type=str,
+                            dest='output',
+                            default=None,
+                            help='Write JSON results to the file instead of stdout')
+    run_parser.add_argument('-r',
+                            '--repeat',
+                            type=int,
+                            dest='repeat',
+                            default=3,
+                            help='Run every stage that many times and report the best time')
+    run_parser.add_argument('--no-memory',
+                            dest='no_memory',
+                            action='store_true',
+                            help='Don\'t measure peak memory with tracemalloc')
+    run_parser.add_argument('--width',
+                            type=int,
+                            dest='width',
+                            default=200,
+                            help='Width of the stub screen')
+    run_parser.add_argument('--height',
+                            type=int,
+                            dest='height',
+                            default=60,
+                            help='Height of the stub screen')
+    run_parser.add_argument('--work-dir',
+                            type=str,
+                            dest='work_dir',
+                            default=None,
+                            help='Keep generated profiles in this directory')
+    add_profile_arguments(run_parser)
+    run_parser.set_defaults(func=benchmark)
+
+    args = parser.parse_args()
+    if args.command is None:
+        parser.error('a command is required')
+    if args.samples < 1 or args.depth < 1 or args.fanout < 1:
+        parser.error('--samples, --depth and --fanout should be at least 1')
+    if args.command == 'run' and args.repeat < 1:
+        parser.error('--repeat should be at least 1')
+    args.func(args)
@@ -0,0 +1,214 @@
+"""Benchmark runner.
+Time every stage of the pipeline on synthetic profiles (see tfg.bench.generators):
+
+    parse - collapser.parse() of the whole file.
+    build - CallFrameTree.add_stacks() of the already parsed stacks.
+    freeze - CallFrameTree.freeze().
+    rebuild_tree, link_frames - VisualFrameTree of the whole screen.
+    draw - FlameGraphWindow.draw() of the whole screen on a stub curses screen.
+
+Every stage is run 'repeat' times and the best time is reported. Peak memory is measured
+with tracemalloc in a separate run, so it doesn't slow down the timed runs.
+"""
+
+import curses
+import gc
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+from tfg.bench.generators import generate_file
+from tfg.browser.terminal import BrowserContext, FlameGraphWindow
+from tfg.browser.visualtree import VisualFrameTree
+from tfg.calltree.calltree import CallFrameTree
+from tfg.stackcollapsers.collapsers import COLLAPSERS
+
+
+FORMAT_VERSION = 1
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+class StubWindow(object):
+    """curses window that doesn't draw anything. Only counts the drawn characters.
+    """
+    def __init__(self, height, width):
+        self.height = height
+        self.width = width
+        self.drawn = 0
+
+    def subwin(self, height, width, y, x):
+        return StubWindow(height, width)
+
+    def addstr(self, y, x, text, attrs=0):
+        self.drawn += len(text)
+
+    def erase(self):
+        pass
+
+    def border(self, *args):
+        pass
+
+    def box(self, *args):
+        pass
+
+    def move(self, y, x):
+        pass
+
+    def noutrefresh(self):
+        pass
+
+
+class StubPalette(object):
+    """Palette that doesn't need curses to be initialized.
+    """
+    lighter = 1
+    normal = 2
+    darker = 3
+    matched = 4
+
+    def gradient(self):
+        while True:
+            yield 5
+            yield 6
+
+    def delta(self, ratio):
+        return 7
+
+
+class _StubCurses(object):
+    """Provide the curses module attributes that only exist after curses.initscr().
+    """
+    ATTRS = ('COLS', 'LINES', 'ACS_HLINE')
+
+    def __init__(self, width, height):
+        self._values = {'COLS': width, 'LINES': height, 'ACS_HLINE': ord('-')}
+        self._saved = {}
+
+    def __enter__(self):
+        for attr in self.ATTRS:
+            if hasattr(curses, attr):
+                self._saved[attr] = getattr(curses, attr)
+            setattr(curses, attr, self._values[attr])
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for attr in self.ATTRS:
+            if attr in self._saved:
+                setattr(curses, attr, self._saved[attr])
+            else:
+                delattr(curses, attr)
+
+
+def _parse(file_type, path):
+    with open(path, 'r') as input_file:
+        return list(COLLAPSERS[file_type](input_file).parse())
+
+
+def _build(stacks):
+    call_tree = CallFrameTree()
+    call_tree.add_stacks(stacks)
+    return call_tree
+
+
+def _draw(call_tree, width, height):
+    with _StubCurses(width, height):
+        context = BrowserContext(None, StubPalette(), ' ')
+        win = FlameGraphWindow(StubWindow(height, width), context)
+        context.vft = VisualFrameTree(call_tree, 0, 0, win.width, win.height - 1)
+        context.current_vf = context.vft.head
+        win.draw()
+    return win
+
+
+def _measure(stage, repeat, memory):
+    """_measure(stage: function, repeat: int, memory: bool) -> (dict, object)
+    Run 'stage' and return its best time, peak memory and the result of the last run.
+    """
+    seconds = None
+    result = None
+    for _ in range(repeat):
+        result = None
+        gc.collect()
+        start = _clock()
+        result = stage()
+        elapsed = _clock() - start
+        if seconds is None or elapsed < seconds:
+            seconds = elapsed
+    stats = {'seconds': seconds, 'peak_memory': None}
+    if memory and tracemalloc is not None:
+        result = None
+        gc.collect()
+        tracemalloc.start()
+        try:
+            result = stage()
+            stats['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return stats, result
+
+
+def benchmark_file(file_type, path, repeat=3, memory=True, width=200, height=60):
+    """benchmark_file(file_type: str, path: str, repeat: int, memory: bool, width: int,
+                      height: int) -> dict
+    Benchmark all stages on the input file of the 'file_type'. (width, height) - size of
+    the screen for the visual tree and draw stages.
+    """
+    results = {}
+    results['parse'], stacks = _measure(lambda: _parse(file_type, path), repeat, memory)
+    results['parse']['stacks'] = len(stacks)
+    results['parse']['bytes'] = os.path.getsize(path)
+    results['build'], call_tree = _measure(lambda: _build(stacks), repeat, memory)
+    stacks = None
+    results['freeze'], frozen_tree = _measure(call_tree.freeze, repeat, memory)
+    results['freeze']['nodes'] = len(frozen_tree)
+    frozen_tree = None
+
+    # Same size as the visual tree of FlameGraphWindow
+    vft = VisualFrameTree(call_tree, 0, 0, width, height - 2)
+    results['rebuild_tree'], _ = _measure(vft.rebuild_tree, repeat, memory)
+    results['rebuild_tree']['visual_frames'] = sum(len(vfs) for vfs in vft.levels())
+    results['link_frames'], _ = _measure(vft.link_frames, repeat, memory)
+    results['draw'], win = _measure(lambda: _draw(call_tree, width, height), repeat, memory)
+    results['draw']['characters'] = win._win.drawn
+    return results
+
+
+def run(file_types, params, repeat=3, memory=True, width=200, height=60, work_dir=None):
+    """run(file_types: list[str], params: ProfileParams, repeat: int, memory: bool,
+           width: int, height: int, work_dir: str) -> dict
+    Generate a profile of every type in 'file_types' and benchmark it. Generated files are
+    put in 'work_dir' and kept there or in a temporary directory that is removed afterwards.
+    Return the JSON-serializable report.
+    """
+    report = {
+        'version': FORMAT_VERSION,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'params': params.as_dict(),
+        'screen': {'width': width, 'height': height},
+        'repeat': repeat,
+        'results': {},
+    }
+    temp_dir = None
+    if work_dir is None:
+        work_dir = temp_dir = tempfile.mkdtemp(prefix='tfg-bench-')
+    try:
+        for file_type in file_types:
+            path = os.path.join(work_dir, 'profile.{}'.format(file_type))
+            generate_file(path, file_type, params)
+            sys.stderr.write('{}: {} bytes\n'.format(file_type, os.path.getsize(path)))
+            report['results'][file_type] = benchmark_file(file_type, path, repeat, memory,
+                                                          width, height)
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir)
+    return report
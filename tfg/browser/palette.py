@@ -5,6 +5,7 @@ flame graph colors seem to be off, you could try set $TERM to "xterm-256color".
 """
 
 import curses
+import math
 from itertools import cycle, chain
 
 
@@ -12,19 +13,26 @@ class Palette(object):
     """Palette for terminal browser.
     Provides gradient generator to infinitely cycle around available colors.
     In additional to that, provides lighter and darker colors (compared to
-    gradient colors).
+    gradient colors) and a color for frames matching a search.
     Supports terminal emulator with [8, 256] colors.
+
+    DIFF palette is used for differential flame graphs. Its gradient only has a neutral
+    color and delta() provides red/blue colors for frames that gained/lost samples.
     """
     HOT = 0
     IO = 1
     WAKEUP = 2
     CHAIN = 3
+    DIFF = 4
 
     def __init__(self, palette):
         self._pairs = None
+        self._increased = []
+        self._decreased = []
         self._lighter = 0
         self._normal = 0
         self._darker = 0
+        self._matched = 0
         if curses.COLORS == 256:
             self._init_256(palette)
         elif curses.COLORS >= 8:
@@ -37,9 +45,12 @@ class Palette(object):
         """Initialize palette for 256-colors terminals
         """
         if palette == Palette.HOT:
-            self._init_pairs([226, 220, 214, 208, 202], 228, 214, 130)
+            self._init_pairs([226, 220, 214, 208, 202], 228, 214, 130, 201)
         elif palette == Palette.IO:
-            self._init_pairs([45, 39, 33, 27, 21], 86, 33, 21)
+            self._init_pairs([45, 39, 33, 27, 21], 86, 33, 21, 201)
+        elif palette == Palette.DIFF:
+            self._init_pairs([252], 231, 250, 244, 201)
+            self._init_diff_pairs([224, 217, 210, 203, 196], [195, 153, 117, 75, 33])
         else:
             raise RuntimeError('Unknown color palette {}'.format(palette))
 
@@ -48,10 +59,17 @@ class Palette(object):
         """
         if palette == Palette.HOT:
             self._init_pairs([curses.COLOR_RED, curses.COLOR_YELLOW],
-                             curses.COLOR_GREEN, curses.COLOR_YELLOW, curses.COLOR_BLUE)
+                             curses.COLOR_GREEN, curses.COLOR_YELLOW, curses.COLOR_BLUE,
+                             curses.COLOR_MAGENTA)
         elif palette == Palette.IO:
             self._init_pairs([curses.COLOR_BLUE, curses.COLOR_CYAN],
-                             curses.COLOR_GREEN, curses.COLOR_BLUE, curses.COLOR_MAGENTA)
+                             curses.COLOR_GREEN, curses.COLOR_BLUE, curses.COLOR_MAGENTA,
+                             curses.COLOR_RED)
+        elif palette == Palette.DIFF:
+            self._init_pairs([curses.COLOR_WHITE],
+                             curses.COLOR_WHITE, curses.COLOR_WHITE, curses.COLOR_CYAN,
+                             curses.COLOR_MAGENTA)
+            self._init_diff_pairs([curses.COLOR_RED], [curses.COLOR_BLUE])
         else:
             raise RuntimeError('Unknown color palette {}'.format(palette))
 
@@ -61,6 +79,18 @@ class Palette(object):
         for i in cycle(chain(self._pairs, self._pairs[1:-1][::-1])):
             yield curses.color_pair(i)
 
+    def delta(self, ratio):
+        """delta(self, ratio: float) -> int
+        Return a color for a frame of a differential flame graph. 'ratio' is in [-1, 1]:
+        > 0 - frame gained samples (red), < 0 - frame lost samples (blue). The bigger
+        the absolute value, the more intense the color.
+        """
+        pairs = self._increased if ratio > 0 else self._decreased
+        level = int(math.ceil(abs(ratio) * len(pairs)))
+        if level == 0:
+            return curses.color_pair(self._pairs[0])
+        return curses.color_pair(pairs[min(level, len(pairs)) - 1])
+
     @property
     def lighter(self):
         return curses.color_pair(self._lighter)
@@ -73,7 +103,11 @@ class Palette(object):
     def darker(self):
         return curses.color_pair(self._darker)
 
-    def _init_pairs(self, gradient_list, light_color, normal_color, dark_color):
+    @property
+    def matched(self):
+        return curses.color_pair(self._matched)
+
+    def _init_pairs(self, gradient_list, light_color, normal_color, dark_color, matched_color):
         self._pairs = []
         for i, color in enumerate(gradient_list):
             curses.init_pair(i + 1, curses.COLOR_BLACK, color)
@@ -81,9 +115,24 @@ class Palette(object):
         self._lighter = len(self._pairs) + 1
         self._normal = self._lighter + 1
         self._darker = self._normal + 1
+        self._matched = self._darker + 1
         curses.init_pair(self._lighter, curses.COLOR_BLACK, light_color)
         curses.init_pair(self._normal, curses.COLOR_BLACK, normal_color)
         curses.init_pair(self._darker, curses.COLOR_BLACK, dark_color)
+        curses.init_pair(self._matched, curses.COLOR_BLACK, matched_color)
+
+    def _init_diff_pairs(self, increased_list, decreased_list):
+        """Initialize colors for frames that gained and lost samples. Both lists go from
+        the smallest change to the biggest one.
+        """
+        self._increased = []
+        self._decreased = []
+        pair = self._matched + 1
+        for colors, pairs in [(increased_list, self._increased), (decreased_list, self._decreased)]:
+            for color in colors:
+                curses.init_pair(pair, curses.COLOR_BLACK, color)
+                pairs.append(pair)
+                pair += 1
 
 
 PALETTES = {
@@ -2,14 +2,43 @@
 Provides a terminal interface to display and interact with a FlameGraph.
 """
 import curses
+import os
+import re
+import sys
+import time
 from tfg.browser.visualtree import VisualFrameTree, fit_string, calculate_width
 from tfg.browser.palette import Palette
+from tfg.calltree.diff import DiffCallFrameTree
+from tfg.stats import get_stats
 
 
 class BrowserException(Exception):
     pass
 
 
+def attach_terminal():
+    """Make sure that curses reads input from the terminal.
+    If the stack file is piped to stdin (e.g. 'perf script | tfg.py -t perf -'), replace
+    stdin with the controlling terminal.
+    """
+    if sys.stdin.isatty():
+        return
+    try:
+        tty_fd = os.open('/dev/tty', os.O_RDONLY)
+    except OSError:
+        raise BrowserException('Input is not a terminal and /dev/tty is not available')
+    os.dup2(tty_fd, sys.stdin.fileno())
+    os.close(tty_fd)
+
+
+def percent(count, total):
+    """percent(count: int, total: int) -> int
+    Return 'count' as a percentage of 'total'. The tree can be empty while it's being
+    loaded, so 'total' could be 0.
+    """
+    return int(count * 100 / total) if total else 0
+
+
 class BrowserContext(object):
     """Common browser variables that can be modified by different windows.
 
@@ -18,19 +47,66 @@ class BrowserContext(object):
     ws_filler - whitespace filler.
     current_vf - current VisualFrame
     win_stack - windows stack
+    full_redraw - True if all windows should be repainted from scratch on the next draw.
+        Otherwise, windows only repaint what has changed since the last draw.
+    search_regex - current search regex or None.
+    matched_frames - call frames matching the current search.
+    matched_count - number of samples in matched_frames.
+    diff - DiffCallFrameTree if a differential flame graph is displayed, otherwise None.
+    loader - BackgroundLoader if the call tree is loaded in the background, otherwise None.
+    loading - True if the call tree is still being loaded. Views that are built from the
+        whole call tree (e.g. the inverted flame graph) are not available until it's loaded.
+    sources - SourceCounts if the call tree is merged from several input files, otherwise None.
+    timeline - SampleTimeline if samples are indexed by time, otherwise None.
+    time_window - [first, last] buckets of the timeline the call tree is built from.
     """
-    def __init__(self, vft, palette, ws_filler):
+    def __init__(self, vft, palette, ws_filler, diff=None, loader=None, sources=None,
+                 timeline=None):
         self.vft = vft
         self.palette = palette
         self.ws_filler = ws_filler
         self.current_vf = None
         self.win_stack = []
+        self.full_redraw = True
+        self.search_regex = None
+        self.matched_frames = set()
+        self.matched_count = 0
+        self.diff = diff
+        self.loader = loader
+        self.loading = loader is not None
+        self.sources = sources
+        self.timeline = timeline
+        self.time_window = (0, len(timeline) - 1) if timeline is not None else None
+
+    def search(self, regex):
+        """search(self, regex: re.Pattern)
+        Find and highlight frames matching 'regex'. Pass None to clear the search.
+        """
+        self.search_regex = regex
+        if regex is None:
+            self.matched_frames, self.matched_count = set(), 0
+        else:
+            self.matched_frames, self.matched_count = self.vft.search(regex)
+        self.full_redraw = True
+
+    def is_matched(self, vf):
+        """is_matched(self, vf: VisualFrameNode) -> bool
+        Return True if 'vf' (or any of the frames combined in it) matches the current search.
+        """
+        if not self.matched_frames:
+            return False
+        if vf.cf is not None:
+            return vf.cf in self.matched_frames
+        return any(c.cf in self.matched_frames for c in vf.combined_frames)
 
 
 class BrowserWindow(object):
     """Base class for all windows
     """
     def draw(self):
+        """Draw the window and mark it for the update with noutrefresh().
+        The screen itself is updated by the browser once all windows are drawn.
+        """
         raise BrowserException('Not implemented')
 
     def process_input(self, stdscr):
@@ -46,10 +122,18 @@ class FlameGraphWindow(BrowserWindow):
         self._context = context
         self._width = curses.COLS
         self._height = curses.LINES - 1
+        if context.timeline is not None:
+            self._height -= TimelineWindow.HEIGHT
         # _start_level is the very bottom frame that we're going to display. This
         # value can be changed if the number of levels > then the screen size.
         self._start_level = 0
         self._win = stdscr.subwin(self._height, self._width, 0, 0)
+        # State of the last draw. Used to repaint only what has changed.
+        self._drawn_head = None
+        self._drawn_start_level = None
+        self._drawn_vf = None
+        # Visual frame -> color it was drawn with
+        self._colors = {}
 
     @property
     def width(self):
@@ -60,28 +144,62 @@ class FlameGraphWindow(BrowserWindow):
         return self._height
 
     def draw(self):
+        # Another window could have jumped to a frame that is not on the screen
+        self._scroll_to(self._context.current_vf)
+        # Repaint everything if the visual tree was rebuilt or scrolled. Otherwise, only
+        # the previous and the new current frames need to be repainted.
+        if self._context.full_redraw or self._drawn_head is not self._context.vft.head or \
+                self._drawn_start_level != self._start_level:
+            self._draw_all()
+        elif self._drawn_vf is not self._context.current_vf:
+            self._draw_frame(self._drawn_vf)
+            self._draw_frame(self._context.current_vf)
+        self._drawn_vf = self._context.current_vf
+        self._win.noutrefresh()
+
+    def _scroll_to(self, vf):
+        if self._start_level <= vf.y <= self._start_level + self._height - 2:
+            return
+        # Put the frame in the middle of the window
+        self._start_level = max(0, vf.y - (self._height - 2) // 2)
+        self._context.vft.set_start_level(self._start_level)
+
+    def _draw_all(self):
+        self._win.erase()
         # Create an invisible border for the window with a line at the bottom
         self._win.border(' ', ' ', ' ', curses.ACS_HLINE,
                          ' ', ' ', curses.ACS_HLINE, curses.ACS_HLINE)
-        self._gradient = self._context.palette.gradient()
-        # Drawing from the bottom to top
-        y = self._height - 2
-        for vfs in self._context.vft.level_traversal():
-            # Skip until the self._start_level
-            if vfs[0].y < self._start_level:
-                continue
+        self._colors = {}
+        gradient = self._context.palette.gradient()
+        for vfs in self._context.vft.levels(self._start_level, self._start_level + self._height - 1):
             for vf in vfs:
                 if vf.width != 0:
-                    self._draw_frame(vf, y)
-            y -= 1
-            if y < 0:
-                break
-
-    def _draw_frame(self, vf, y):
-        color = next(self._gradient)
+                    self._colors[vf] = self._frame_color(vf, gradient)
+                    self._draw_frame(vf)
+        self._drawn_head = self._context.vft.head
+        self._drawn_start_level = self._start_level
+
+    def _frame_color(self, vf, gradient):
+        diff = self._context.diff
+        # Differential flame graph frames are colored by the change of their sample share
+        if diff is not None and vf.cf is not None:
+            return self._context.palette.delta(
+                diff.delta(vf.cf) / diff.max_delta if diff.max_delta else 0)
+        return next(gradient)
+
+    def _draw_frame(self, vf):
+        # Skip frames that are not on the screen
+        color = self._colors.get(vf)
+        if color is None:
+            return
+        # Drawing from the bottom to top
+        y = self._height - 2 - (vf.y - self._start_level)
 
-        # We want to draw zoomed frames with a bit ligher colors.
-        if vf.zoomed:
+        # Frames matching the search are always highlighted. We want to draw zoomed
+        # frames with a bit ligher colors.
+        if self._context.is_matched(vf):
+            attrs = self._context.palette.matched
+        elif vf.zoomed:
             attrs = self._context.palette.lighter
         else:
             attrs = color
@@ -112,6 +230,7 @@ class FlameGraphWindow(BrowserWindow):
             # Go down if the current visual frame is below the window.
             if self._context.current_vf.y < self._start_level:
                 self._start_level -= 1
+                self._context.vft.set_start_level(self._start_level)
         # Go up to the first visible children.
         elif char == curses.KEY_UP:
             for frame in self._context.current_vf.frames:
@@ -121,6 +240,7 @@ class FlameGraphWindow(BrowserWindow):
             # Go up if the current visual frame is above the window.
             if self._context.current_vf.y > self._start_level + self._height - 2:
                 self._start_level += 1
+                self._context.vft.set_start_level(self._start_level)
         # Go left to the sibling.
         elif char == curses.KEY_LEFT:
             if self._context.current_vf.left_vf is not None:
@@ -136,6 +256,25 @@ class FlameGraphWindow(BrowserWindow):
                 self._context.vft.link_frames()
             elif self._context.current_vf.combined_frames:
                 self._context.win_stack.append(SelectVisualFrameWindow(stdscr, self._context))
+        # Switch between the normal and the inverted flame graph.
+        elif char == ord('i'):
+            if not self._context.loading:
+                self._invert()
+        # Show the top functions table.
+        elif char == ord('t'):
+            self._context.win_stack.append(TopFunctionsWindow(stdscr, self._context))
+        # Search frames by a regex.
+        elif char == ord('/'):
+            self._context.win_stack.append(SearchWindow(stdscr, self._context))
+        # Stop loading and keep what was loaded so far.
+        elif char == ord('x'):
+            if self._context.loading:
+                self._context.loader.cancel()
+        # Select a time window.
+        elif char == ord('w'):
+            if self._context.timeline is not None:
+                self._context.win_stack.append(
+                    TimeWindowSelectWindow(stdscr, self._context, self._set_call_tree))
         # Reset.
         elif char == ord('r'):
             self._context.current_vf = self._context.vft.rebuild_tree(self._context.vft.head)
@@ -143,37 +282,386 @@ class FlameGraphWindow(BrowserWindow):
         # Ignore anything else
 
 
+    def _invert(self):
+        call_tree = self._context.vft.call_tree.inverted()
+        if self._context.diff is not None:
+            self._context.diff = call_tree
+        self._set_call_tree(call_tree)
+
+    def _set_call_tree(self, call_tree):
+        """Display another call tree from its head frame.
+        """
+        self._start_level = 0
+        self._context.current_vf = self._context.vft.set_call_tree(call_tree)
+        # Matched frames belong to the previous tree
+        if self._context.search_regex is not None:
+            self._context.search(self._context.search_regex)
+
+
+def format_size(size):
+    """format_size(size: int) -> str
+    Return a human readable size: 512B, 1.5K, 12.3M, etc.
+    """
+    for unit in ('B', 'K', 'M', 'G'):
+        if size < 1024 or unit == 'G':
+            return '%d%s' % (size, unit) if unit == 'B' else '%.1f%s' % (size, unit)
+        size /= 1024.0
+
+
 class StatusWindow(BrowserWindow):
     """Status window.
-    Simply displays the full name of the current visual frame
+    Displays the full name of the current visual frame and the percentage of samples
+    matching the current search. If the call tree is merged from several input files,
+    also displays how samples of the current frame are distributed between them.
+    While the call tree is being loaded, displays the loading progress.
     """
+    # Number of input files with the most samples to display
+    TOP_SOURCES = 3
+
     def __init__(self, stdscr, context):
         self._context = context
         self._width = curses.COLS
         self._height = 1
         self._win = stdscr.subwin(self._height, self._width, curses.LINES - 1, 0)
+        # Call frame the sources string was built for and the string itself
+        self._sources_cf = None
+        self._sources_string = ''
 
     def draw(self):
-        if self._context.current_vf.cf is not None:
+        # Search results are displayed at the right side of the window
+        search_string = ''
+        if self._context.search_regex is not None:
+            total_count = self._context.vft.call_tree.head.count
+            search_string = ' /%s match=%.1f%%' % (
+                self._context.search_regex.pattern,
+                self._context.matched_count * 100.0 / total_count if total_count else 0)
+            search_string = search_string[-(self._width - 1):]
+        search_string = (self._progress() + search_string)[-(self._width - 1):]
+        width = self._width - 1 - len(search_string)
+        diff = self._context.diff
+        if diff is not None and self._context.current_vf.cf is not None:
+            cf = self._context.current_vf.cf
+            name = fit_string(
+                "%s old=%.2f%% new=%.2f%% delta=%+.2f%% self delta=%+.2f%%" %
+                (cf.name, cf.old_count * 100.0 / diff.old_total if diff.old_total else 0,
+                 cf.count * 100.0 / diff.head.count if diff.head.count else 0,
+                 diff.delta(cf) * 100, diff.self_delta(cf) * 100),
+                width, ' ')
+        elif self._context.current_vf.cf is not None:
             cf = self._context.current_vf.cf
             parent = cf.parent or cf
-            self_time_total = int(cf.base_count * 100 / self._context.vft._call_tree.head.count)
-            combined_time_total = int(cf.count * 100 / self._context.vft._call_tree.head.count)
-            self_time_parent = int(cf.base_count * 100 / parent.count)
-            combined_time_parent = int(cf.count * 100 / parent.count)
+            total_count = self._context.vft.call_tree.head.count
+            self_time_total = percent(cf.base_count, total_count)
+            combined_time_total = percent(cf.count, total_count)
+            self_time_parent = percent(cf.base_count, parent.count)
+            combined_time_parent = percent(cf.count, parent.count)
             name = fit_string(
-                "%s self=%s%% aggregate=%s%% self/parent=%s%% aggregate/parent=%s%%" %
+                "%s self=%s%% aggregate=%s%% self/parent=%s%% aggregate/parent=%s%%%s" %
                 (self._context.current_vf.cf.name, self_time_total, self_time_parent, combined_time_total,
-                 combined_time_parent),
-                self._width - 1, ' ')
+                 combined_time_parent, self._sources(cf)),
+                width, ' ')
         else:
-            name = self._context.current_vf.text
-        self._win.addstr(0, 0, name)
+            name = fit_string(self._context.current_vf.text, width, ' ')
+        # The status line is short, so it's always repainted. curses will only send the
+        # characters that actually changed to the terminal.
+        self._win.erase()
+        self._win.addstr(0, 0, name + search_string)
+        self._win.noutrefresh()
 
     def process_input(self, stdscr):
         # Focus can't be on the status window, so we just quit.
         self._context.win_stack.pop()
 
+    def _progress(self):
+        """Return a string with the bytes read, the number of samples and the loading rate
+        or '' if nothing is being loaded. It's also displayed after loading is cancelled, so
+        it's clear that the flame graph is incomplete.
+        """
+        loader = self._context.loader
+        if loader is None or loader.start_time is None or loader.completed:
+            return ''
+        elapsed = (loader.end_time or time.time()) - loader.start_time
+        progress = ' [%s' % ('cancelled' if loader.cancelled else 'loading')
+        reader = loader.reader
+        if reader is not None:
+            if reader.size:
+                progress += ' %d%% %s/%s' % (percent(reader.position, reader.size),
+                                             format_size(reader.position),
+                                             format_size(reader.size))
+            else:
+                progress += ' %s' % format_size(reader.position)
+        progress += ' %d samples' % loader.samples
+        if elapsed > 0 and not loader.cancelled:
+            progress += ' %d/s' % (loader.samples / elapsed)
+        return progress + ']'
+
+    def _sources(self, cf):
+        """Return a string with the input files that have the most samples in 'cf'.
+        The string is only rebuilt when the current frame changes, since the frame has to be
+        looked up in every input file tree.
+        """
+        sources = self._context.sources
+        # Counts are only known for the merged tree and not for e.g. the inverted one
+        if sources is None or self._context.vft.call_tree is not sources.call_tree:
+            return ''
+        if cf != self._sources_cf:
+            counts = sources.counts(cf)
+            self._sources_string = ' sources=%d/%d %s' % (
+                len(counts), len(sources),
+                ' '.join('%s=%s%%' % (source, percent(count, cf.count))
+                         for source, count in counts[:self.TOP_SOURCES]))
+            self._sources_cf = cf
+        return self._sources_string
+
+
+class TimelineWindow(BrowserWindow):
+    """Timeline window.
+    Displays a sparkline of the number of samples over time right above the status window.
+    Columns of the selected time window are highlighted and its time range (relative to the
+    first sample) and share of samples are displayed at the right side.
+    """
+    HEIGHT = 1
+    # Sparkline characters from the fewest to the most samples
+    LEVELS = ' .:-=+*#%@'
+    LABEL_WIDTH = 28
+
+    def __init__(self, stdscr, context):
+        self._context = context
+        self._width = curses.COLS
+        self._win = stdscr.subwin(self.HEIGHT, self._width, curses.LINES - 1 - self.HEIGHT, 0)
+        timeline = context.timeline
+        buckets = len(timeline)
+        columns = max(1, min(buckets, self._width - 1 - self.LABEL_WIDTH))
+        # [first, last] buckets of every column
+        self._columns = [(column * buckets // columns, (column + 1) * buckets // columns - 1)
+                         for column in range(columns)]
+        counts = [sum(timeline.counts[first:last + 1]) for first, last in self._columns]
+        max_count = max(counts) if counts else 0
+        levels = len(self.LEVELS) - 1
+        # Columns with any samples get at least the lowest level, so they're never blank
+        self._sparkline = ''.join(
+            self.LEVELS[-(-count * levels // max_count)] if count else self.LEVELS[0]
+            for count in counts)
+        self._total_count = sum(timeline.counts)
+
+    def draw(self):
+        self._draw_sparkline(self._context.time_window)
+        self._win.noutrefresh()
+
+    def process_input(self, stdscr):
+        # Focus can't be on the timeline window, TimeWindowSelectWindow is used instead
+        self._context.win_stack.pop()
+
+    def _draw_sparkline(self, time_window, cursor=None):
+        """Draw the sparkline with 'time_window' ([first, last] buckets) highlighted and
+        the 'cursor' column (if any) in standout.
+        """
+        first, last = time_window
+        self._win.erase()
+        for column, (column_first, column_last) in enumerate(self._columns):
+            attrs = curses.A_NORMAL
+            if column_first <= last and column_last >= first:
+                attrs = self._context.palette.normal
+            if column == cursor:
+                attrs |= curses.A_STANDOUT
+            self._win.addstr(0, column, self._sparkline[column], attrs)
+        timeline = self._context.timeline
+        count = sum(timeline.counts[first:last + 1])
+        label = ' %.3fs-%.3fs %.1f%%' % (
+            timeline.bucket_start(first) - timeline.start,
+            timeline.bucket_start(last + 1) - timeline.start,
+            count * 100.0 / self._total_count if self._total_count else 0)
+        x = len(self._columns)
+        self._win.addstr(0, x, fit_string(label, self._width - 1 - x, ' '))
+
+    def _buckets(self, first_column, last_column):
+        """Return [first, last] buckets of the columns [first_column, last_column].
+        """
+        return self._columns[first_column][0], self._columns[last_column][1]
+
+
+class TimeWindowSelectWindow(TimelineWindow):
+    """Time window selection window.
+    Draws over the timeline window while a time window is selected: arrow keys move the
+    cursor, 'Space' marks the start of the window at the cursor and 'Enter' displays the
+    call tree of the samples between the mark and the cursor. 'a' displays all samples.
+    """
+    def __init__(self, stdscr, context, on_select):
+        """on_select - function that displays a call tree.
+        """
+        super(TimeWindowSelectWindow, self).__init__(stdscr, context)
+        self._on_select = on_select
+        first, last = self._context.time_window
+        self._mark = None
+        self._cursor = 0
+        for column, (column_first, column_last) in enumerate(self._columns):
+            if column_first <= first <= column_last:
+                self._cursor = column
+                break
+
+    def draw(self):
+        mark = self._cursor if self._mark is None else self._mark
+        self._draw_sparkline(self._buckets(min(mark, self._cursor), max(mark, self._cursor)),
+                             self._cursor)
+        self._win.noutrefresh()
+
+    def process_input(self, stdscr):
+        char = stdscr.getch()
+        # Cancel.
+        if char in [ord('q'), 27]:
+            self._context.win_stack.pop()
+        # Move the cursor.
+        elif char == curses.KEY_LEFT:
+            self._cursor = max(0, self._cursor - 1)
+        elif char == curses.KEY_RIGHT:
+            self._cursor = min(len(self._columns) - 1, self._cursor + 1)
+        elif char == curses.KEY_HOME:
+            self._cursor = 0
+        elif char == curses.KEY_END:
+            self._cursor = len(self._columns) - 1
+        # Mark the start of the window.
+        elif char == ord(' '):
+            self._mark = self._cursor
+        # Display the samples of the window and quit.
+        elif char in [curses.KEY_ENTER, ord('\n')]:
+            mark = self._cursor if self._mark is None else self._mark
+            first, last = self._buckets(min(mark, self._cursor), max(mark, self._cursor))
+            self._context.time_window = (first, last)
+            self._on_select(self._context.timeline.tree(first, last))
+            self._context.win_stack.pop()
+        # Display all samples and quit.
+        elif char == ord('a'):
+            self._context.time_window = (0, len(self._context.timeline) - 1)
+            self._on_select(self._context.timeline.full_tree())
+            self._context.win_stack.pop()
+
+
+class SearchWindow(BrowserWindow):
+    """Search window.
+    Replaces the status window while a search regex is typed. An empty regex clears
+    the search.
+    """
+    def __init__(self, stdscr, context):
+        self._context = context
+        self._width = curses.COLS
+        self._win = stdscr.subwin(1, self._width, curses.LINES - 1, 0)
+        self._text = self._context.search_regex.pattern if self._context.search_regex else ''
+        self._error = ''
+
+    def draw(self):
+        line = '/' + self._text
+        if self._error:
+            line = '{}  [{}]'.format(line, self._error)
+        self._win.erase()
+        self._win.addstr(0, 0, line[:self._width - 1])
+        # Put the cursor at the end of the typed text
+        self._win.move(0, min(len(self._text) + 1, self._width - 1))
+        self._win.noutrefresh()
+
+    def process_input(self, stdscr):
+        char = stdscr.getch()
+        # Cancel.
+        if char == 27:
+            self._context.win_stack.pop()
+        # Search.
+        elif char in [curses.KEY_ENTER, ord('\n')]:
+            if not self._text:
+                self._context.search(None)
+                self._context.win_stack.pop()
+                return
+            try:
+                regex = re.compile(self._text)
+            except re.error as err:
+                self._error = str(err)
+                return
+            self._context.search(regex)
+            self._context.win_stack.pop()
+        # Remove the last character.
+        elif char in [curses.KEY_BACKSPACE, 127, 8]:
+            self._text = self._text[:-1]
+            self._error = ''
+        # Add a character.
+        elif 32 <= char < 127:
+            self._text += chr(char)
+            self._error = ''
+        # Ignore anything else
+
+
+class TopFunctionsWindow(BrowserWindow):
+    """Top functions window.
+    Displays a table with self and total samples of every function. Choosing a function
+    zooms in its hottest frame.
+    """
+    SORT_KEYS = {
+        ord('s'): lambda f: (-f.self_count, -f.total_count, f.name),
+        ord('t'): lambda f: (-f.total_count, -f.self_count, f.name),
+        ord('n'): lambda f: f.name,
+    }
+    HEADER = '{:>8} {:>8}  {}'.format('Self', 'Total', 'Function')
+
+    def __init__(self, stdscr, context):
+        self._context = context
+        self._width = curses.COLS
+        # Leave the status window visible
+        self._height = curses.LINES - 1
+        self._win = stdscr.subwin(self._height, self._width, 0, 0)
+        self._total_count = self._context.vft.call_tree.head.count
+        self._functions = self._context.vft.function_stats()
+        self._functions.sort(key=self.SORT_KEYS[ord('s')])
+        # Displayed rows are [_from, _from + rows)
+        self._rows = self._height - 1
+        self._from = 0
+        self._current = 0
+
+    def draw(self):
+        self._win.erase()
+        self._win.addstr(0, 0, fit_string(self.HEADER, self._width - 1, ' '), curses.A_BOLD)
+        y = 1
+        for i, function in enumerate(self._functions[self._from:self._from + self._rows]):
+            line = '{:>7.2f}% {:>7.2f}%  {}'.format(
+                function.self_count * 100.0 / self._total_count if self._total_count else 0,
+                function.total_count * 100.0 / self._total_count if self._total_count else 0,
+                function.name)
+            attrs = curses.A_STANDOUT if self._from + i == self._current else curses.A_NORMAL
+            self._win.addstr(y, 0, fit_string(line, self._width - 1, ' '), attrs)
+            y += 1
+        self._win.noutrefresh()
+
+    def process_input(self, stdscr):
+        char = stdscr.getch()
+        # Quit.
+        if char == ord('q'):
+            self._context.win_stack.pop()
+        # Go down.
+        elif char == curses.KEY_DOWN:
+            self._select(self._current + 1)
+        # Go up.
+        elif char == curses.KEY_UP:
+            self._select(self._current - 1)
+        # Next page.
+        elif char == curses.KEY_NPAGE:
+            self._select(self._current + self._rows)
+        # Previous page.
+        elif char == curses.KEY_PPAGE:
+            self._select(self._current - self._rows)
+        # Sort by self, total samples or by name.
+        elif char in self.SORT_KEYS:
+            self._functions.sort(key=self.SORT_KEYS[char])
+            self._select(0)
+        # Zoom in the hottest frame of the function and quit.
+        elif char in [curses.KEY_ENTER, ord('\n')]:
+            if self._functions:
+                hottest = self._functions[self._current].hottest
+                self._context.current_vf = self._context.vft.zoom_to(hottest)
+            self._context.win_stack.pop()
+
+    def _select(self, current):
+        self._current = max(0, min(current, len(self._functions) - 1))
+        if self._current < self._from:
+            self._from = self._current
+        elif self._current >= self._from + self._rows:
+            self._from = self._current - self._rows + 1
+
 
 class SelectVisualFrameWindow(BrowserWindow):
     """Select visual frame window.
@@ -210,6 +698,7 @@ class SelectVisualFrameWindow(BrowserWindow):
         self._current = 0
 
     def draw(self):
+        self._win.erase()
         self._win.box(0, 0)
         x = self._BORDER_SIZE // 2
         y = self._BORDER_SIZE // 2
@@ -229,6 +718,7 @@ class SelectVisualFrameWindow(BrowserWindow):
                 self._win.addstr(y, 1, fit_string(number_string, self._NUMBER_SIZE, ' '),
                                  curses.A_STANDOUT)
             y += 1
+        self._win.noutrefresh()
 
     def process_input(self, stdscr):
         char = stdscr.getch()
@@ -258,34 +748,154 @@ class SelectVisualFrameWindow(BrowserWindow):
 
 class TerminalBrowser(object):
     """Terminal browser power by ncurses library.
+
+    If 'loader' (BackgroundLoader) is given, the call tree is still being loaded, so the
+    flame graph is refreshed every 'refresh_interval' seconds while there is new data.
+    DiffCallFrameTree is displayed as a differential flame graph with the DIFF palette.
+    If 'sources' (SourceCounts) is given, the status line shows which input files the
+    samples of the current frame came from.
+    If 'timeline' (SampleTimeline) is given, a sparkline of samples over time is displayed
+    above the status line and the call tree of any time window can be displayed.
+    When the terminal is resized, all windows are recreated for the new size and windows
+    opened on top of the flame graph are closed.
     """
-    def __init__(self, call_tree, ws_filler, palette_type):
+    # Nothing but a message is drawn in a smaller terminal
+    MIN_LINES = 5
+    MIN_COLS = 20
+
+    def __init__(self, call_tree, ws_filler, palette_type, loader=None, refresh_interval=1.0,
+                 sources=None, timeline=None):
         self._call_tree = call_tree
+        self._sources = sources
+        self._timeline = timeline
         self._ws_filler = ws_filler
         self._palette_type = palette_type
+        self._loader = loader
+        self._refresh_interval = refresh_interval
         self._fg_win = None
         self._select_vf_win = None
         self._context = None
 
     def display(self):
+        attach_terminal()
         # This wrapper will initialize all curses stuff before calling self._display() and
         # it will also properly deinit them when we'll return from self._display() or raise
         # an exception.
         curses.wrapper(self._display)
 
     def _display(self, stdscr):
-        palette = Palette(self._palette_type)
-        self._context = BrowserContext(None, palette, self._ws_filler)
-        vf_win = FlameGraphWindow(stdscr, self._context)
-        vft = VisualFrameTree(self._call_tree, 0, 0, vf_win.width, vf_win.height - 1, self._ws_filler)
+        # Erased cells should keep the terminal background, not the curses default black
+        try:
+            curses.use_default_colors()
+        except curses.error:
+            pass
+        diff = None
+        if isinstance(self._call_tree, DiffCallFrameTree):
+            diff = self._call_tree
+            palette = Palette(Palette.DIFF)
+        else:
+            palette = Palette(self._palette_type)
+        self._context = BrowserContext(None, palette, self._ws_filler, diff,
+                                       self._loader, self._sources, self._timeline)
+        if self._too_small():
+            raise BrowserException('Terminal is too small, it should be at least {}x{}'.format(
+                self.MIN_COLS, self._min_lines()))
+        self._create_windows(stdscr)
+        lock = self._loader.lock if self._loader is not None else None
+        stats = get_stats()
+        with stats.phase('visual tree'):
+            vft = VisualFrameTree(self._call_tree, 0, 0, self._fg_win.width,
+                                  self._fg_win.height - 1, self._ws_filler, lock=lock)
         self._context.vft = vft
         self._context.current_vf = self._context.vft.head
-        self._context.win_stack.append(StatusWindow(stdscr, self._context))
-        self._context.win_stack.append(vf_win)
 
+        generation = None
+        if self._loader is not None:
+            generation = self._loader.generation
+            # Don't block on input forever, so we could refresh the flame graph
+            stdscr.timeout(int(self._refresh_interval * 1000))
+        last_refresh = time.time()
+
+        drawn_win_stack = None
+        first_draw = stats.phase('first draw')
         while self._context.win_stack:
-            stdscr.clear()
-            # Draw all windows but process input only on the last one
-            for win in self._context.win_stack:
-                win.draw()
+            # A window was opened or closed, so everything under it has to be repainted
+            if drawn_win_stack != self._context.win_stack:
+                self._context.full_redraw = True
+            if first_draw is not None:
+                with first_draw:
+                    self._draw(stdscr)
+                first_draw = None
+            else:
+                self._draw(stdscr)
+            drawn_win_stack = self._context.win_stack[:]
             self._context.win_stack[-1].process_input(stdscr)
+            # Windows ignore KEY_RESIZE, the new size is checked here whatever window is open
+            if self._context.win_stack and stdscr.getmaxyx() != (curses.LINES, curses.COLS):
+                self._resize(stdscr)
+
+            # Once the loader stops, the tree doesn't change anymore: refresh it for the last
+            # time and stop waking up to refresh it.
+            if self._context.loading and not self._loader.is_alive():
+                self._context.loading = False
+                last_refresh = 0
+                stdscr.timeout(-1)
+            # Refresh only if there is new data and no other window is open on top of
+            # the flame graph.
+            if generation is not None and self._context.win_stack and \
+                    self._context.win_stack[-1] is self._fg_win and \
+                    time.time() - last_refresh >= self._refresh_interval and \
+                    self._loader.generation != generation:
+                generation = self._loader.generation
+                last_refresh = time.time()
+                self._context.current_vf = vft.refresh(self._context.current_vf)
+                # New frames could match the search too
+                if self._context.search_regex is not None:
+                    self._context.search(self._context.search_regex)
+
+    def _create_windows(self, stdscr):
+        """Create the flame graph, status and timeline windows for the current terminal size.
+        """
+        self._fg_win = FlameGraphWindow(stdscr, self._context)
+        self._context.win_stack = [StatusWindow(stdscr, self._context)]
+        if self._timeline is not None:
+            self._context.win_stack.append(TimelineWindow(stdscr, self._context))
+        self._context.win_stack.append(self._fg_win)
+
+    def _resize(self, stdscr):
+        """Recreate windows and rebuild the visual tree for the new terminal size.
+        """
+        # curses only updates LINES and COLS on initscr()
+        curses.LINES, curses.COLS = stdscr.getmaxyx()
+        self._context.full_redraw = True
+        if self._too_small():
+            # Windows are recreated once the terminal is big enough again
+            return
+        self._create_windows(stdscr)
+        self._context.current_vf = self._context.vft.resize(
+            self._fg_win.width, self._fg_win.height - 1, self._context.current_vf)
+
+    def _min_lines(self):
+        return self.MIN_LINES + (TimelineWindow.HEIGHT if self._timeline is not None else 0)
+
+    def _too_small(self):
+        return curses.LINES < self._min_lines() or curses.COLS < self.MIN_COLS
+
+    def _draw(self, stdscr):
+        """Draw all windows and update the screen.
+        """
+        if self._too_small():
+            stdscr.erase()
+            stdscr.addstr(0, 0, 'Terminal is too small'[:curses.COLS - 1])
+            stdscr.noutrefresh()
+            curses.doupdate()
+            return
+        if self._context.full_redraw:
+            stdscr.erase()
+            stdscr.noutrefresh()
+        # Draw all windows but process input only on the last one
+        for win in self._context.win_stack:
+            win.draw()
+        # Send all changes to the terminal at once
+        curses.doupdate()
+        self._context.full_redraw = False
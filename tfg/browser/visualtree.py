@@ -1,8 +1,11 @@
 """Call frames stack representation as a visual tree.
 Visual tree is a tree where each node contains an enough information to draw it on screen.
 """
-from itertools import tee
+import threading
+from itertools import chain, tee
 from functools import partial
+from tfg.calltree.calltree import total_count
+from tfg.calltree.functions import function_stats
 
 
 def pairwise(iterable):
@@ -70,13 +73,28 @@ class VisualFrameNode(object):
 
 
 class VisualFrameTree(object):
-    def __init__(self, call_tree, x, y, width, height, ws_filler=' ', with_combined_frames=True):
+    """Visual frames for the levels that can be displayed.
+    Visual frames are built lazily level by level: only for the visible levels
+    [start_level, start_level + height) plus LEVEL_MARGIN levels above them (and for all
+    levels below, since those are needed to lay out the visible ones). Use
+    set_start_level() and expand_to() to build more levels when needed.
+
+    Built frames are indexed by level: levels()[y] is a list of all frames with that
+    'y' in the breadth-first order (i.e. from right to left). Left and right frames
+    are linked following this order.
+    """
+    LEVEL_MARGIN = 4
+
+    def __init__(self, call_tree, x, y, width, height, ws_filler=' ', with_combined_frames=True,
+                 lock=None):
         """__init__(self, call_tree: CallFrameTree, x: int, y: int, width: int, height: int,
-                    ws_filler:str, with_combined_frames: bool)
+                    ws_filler:str, with_combined_frames: bool, lock: threading.Lock)
         (x, y) - top left corner of the area to draw on.
         (width, height) - size of the area to draw on.
+        lock - lock to hold while reading the call tree if it's modified by another thread.
         """
         self._call_tree = call_tree
+        self._lock = lock or threading.Lock()
         self._x = x
         self._y = y
         self._width = width
@@ -84,27 +102,158 @@ class VisualFrameTree(object):
         self._ws_filler = ws_filler
         self._start_vf = None
         self._with_combined_frames = with_combined_frames
+        # The lowest visible level
+        self._start_level = 0
+        # Frames of every built level. Children of the frames on the last level are
+        # not created yet.
+        self._levels = []
         self.rebuild_tree()
         self.link_frames()
 
     def rebuild_tree(self, start_vf=None):
         """Rebuild the whole tree. Use start_vf as a zoomed frame.
         """
-        text = fit_string(self._call_tree.head.name, self._width, self._ws_filler)
-        self._head = VisualFrameNode(self._x, 0, self._call_tree.head.count, self._width, text)
-        self._head.cf = self._call_tree.head
-        self._head.zoomed = True
-        start_vf = self._create_start_vf(start_vf, self._width)
-        self._create_vf_children(start_vf, start_vf.cf)
+        with self._lock:
+            text = fit_string(self._call_tree.head.name, self._width, self._ws_filler)
+            self._head = VisualFrameNode(self._x, 0, self._call_tree.head.count, self._width, text)
+            self._head.cf = self._call_tree.head
+            self._head.zoomed = True
+            start_vf = self._create_start_vf(start_vf, self._width)
+            # Levels below the zoomed frame only have the zoomed frame parents
+            self._levels = []
+            vf = start_vf
+            while vf is not None:
+                self._levels.append([vf])
+                vf = vf.parent_vf
+            self._levels.reverse()
+            # Always build children of the zoomed frame, even if it's above the screen
+            self._expand(max(self._wanted_level(), start_vf.y + 1))
+        return start_vf
+
+    def zoom_to(self, cf):
+        """zoom_to(self, cf: CallFrameNode) -> VisualFrameNode
+        Rebuild the tree using the call frame 'cf' as a zoomed frame. Return its visual frame.
+        """
+        cfs = []
+        while cf is not None:
+            cfs.append(cf)
+            cf = cf.parent
+        # rebuild_tree() only needs the parent chain of the zoomed frame
+        vf = None
+        for y, cf in enumerate(reversed(cfs)):
+            vf = VisualFrameNode(self._x, y, cf.count, self._width, cf.name, vf, cf=cf)
+        start_vf = self.rebuild_tree(vf)
+        self.link_frames()
         return start_vf
 
+    def set_start_level(self, level):
+        """set_start_level(self, level: int)
+        Set the lowest visible level and build visual frames for newly visible levels.
+        """
+        self._start_level = level
+        self.expand_to(self._wanted_level())
+
+    def expand_to(self, level):
+        """expand_to(self, level: int)
+        Make sure that visual frames up to the 'level' are built (if there are any).
+        Newly built frames are linked with their neighbors.
+        """
+        if level < len(self._levels) or not self._levels[-1]:
+            return
+        first_new_level = len(self._levels)
+        with self._lock:
+            self._expand(level)
+        # Link new levels and the last frame of the previous level
+        self._link(first_new_level - 1)
+
+    def _wanted_level(self):
+        return self._start_level + self._height + self.LEVEL_MARGIN
+
+    def _expand(self, level):
+        """Build visual frames level by level up to the 'level'.
+        The last level in self._levels is always empty if there is nothing more to build.
+        """
+        while len(self._levels) <= level and self._levels[-1]:
+            next_level = []
+            for vf in self._levels[-1]:
+                # Combined frames don't have children
+                if vf.cf is not None:
+                    self._create_vf_children(vf, vf.cf)
+                    next_level.extend(vf.frames)
+            self._levels.append(next_level)
+
+    def refresh(self, current_vf):
+        """refresh(self, current_vf: VisualFrameNode) -> VisualFrameNode
+        Rebuild the tree after new stacks were added to the call tree. Keep the zoomed
+        frame and return the new visual frame for 'current_vf' (or for its closest
+        ancestor if the frame is not visible anymore).
+        """
+        cfs = []
+        while current_vf is not None:
+            cfs.append(current_vf.cf)
+            current_vf = current_vf.parent_vf
+        self.rebuild_tree(self._start_vf)
+        self.link_frames()
+
+        vf = self._head
+        # Skip the head frame and go up from there
+        for cf in cfs[-2::-1]:
+            for child_vf in vf.frames:
+                # Note: combined frames don't have cf
+                if child_vf.cf == cf:
+                    vf = child_vf
+                    break
+            else:
+                break
+        return vf
+
+    def resize(self, width, height, current_vf):
+        """resize(self, width: int, height: int, current_vf: VisualFrameNode) -> VisualFrameNode
+        Rebuild the tree for the new size of the area to draw on. Keep the zoomed frame and
+        return the new visual frame for 'current_vf' (see refresh()).
+        """
+        self._width = width
+        self._height = height
+        self._start_level = 0
+        return self.refresh(current_vf)
+
+    def search(self, regex):
+        """search(self, regex: re.Pattern) -> (set[CallFrameNode], int)
+        Return call frames with a name matching 'regex' and the number of samples in them
+        (samples of nested matching frames are counted once).
+        """
+        with self._lock:
+            frames = self._call_tree.find_frames(regex)
+            return set(frames), total_count(frames)
+
+    def function_stats(self):
+        """function_stats(self) -> list[FunctionStats]
+        Return statistics for every function in the call tree.
+        """
+        with self._lock:
+            return function_stats(self._call_tree.head)
+
     def link_frames(self):
         """Link left and right frames.
         """
-        for lvf, rvf in pairwise(self.bfs_traversal()):
+        self._link(0)
+
+    def _link(self, start_level):
+        """Link left and right frames starting from the last frame of the 'start_level'.
+        The leftmost frame of a level is linked with the rightmost frame of the next level.
+        """
+        vfs = chain(self._levels[start_level][-1:],
+                    chain.from_iterable(self._levels[start_level + 1:]))
+        for lvf, rvf in pairwise(vfs):
             lvf.left_vf = rvf
             rvf.right_vf = lvf
 
+    def levels(self, start_level=0, end_level=None):
+        """levels(self, start_level: int, end_level: int) -> list[list[VisualFrameNode]]
+        Return frames for every built level in [start_level, end_level).
+        """
+        return [vfs for vfs in self._levels[start_level:end_level] if vfs]
+
     def dfs_traversal(self):
         """Return depth-first search traversal iterator.
         """
@@ -118,29 +267,12 @@ class VisualFrameTree(object):
     def bfs_traversal(self):
         """Return breadth-first search traversal iterator.
         """
-        def bfs_iterator(vf):
-            queue = [vf]
-            while queue:
-                vf = queue.pop(0)
-                yield vf
-                queue.extend(vf.frames)
-        return partial(bfs_iterator, self._head)()
+        return chain.from_iterable(self._levels)
 
     def level_traversal(self):
         """Return level traversal iterator.
         """
-        def level_iterator(vf):
-            bfs = self.bfs_traversal()
-            vfs = [next(bfs)]
-            for vf in bfs:
-                if vfs[0].y == vf.y:
-                    vfs.append(vf)
-                else:
-                    yield vfs
-                    vfs = [vf]
-            if vfs:
-                yield vfs
-        return partial(level_iterator, self._head)()
+        return iter(self.levels())
 
     @property
     def with_combined_frames(self):
@@ -154,6 +286,21 @@ class VisualFrameTree(object):
     def head(self):
         return self._head
 
+    @property
+    def call_tree(self):
+        return self._call_tree
+
+    def set_call_tree(self, call_tree):
+        """set_call_tree(self, call_tree: CallFrameTree) -> VisualFrameNode
+        Display another call tree (e.g. the inverted one) from its head frame. Return the
+        new head visual frame.
+        """
+        self._call_tree = call_tree
+        self._start_level = 0
+        head = self.rebuild_tree()
+        self.link_frames()
+        return head
+
     @property
     def start_vf(self):
         return self._start_vf
@@ -171,7 +318,8 @@ class VisualFrameTree(object):
             self._start_vf = self._head
             for parent in start_vf_parents[:-1][::-1]:
                 text = fit_string(parent.cf.name, width, self._ws_filler)
-                vf = VisualFrameNode(self._x, parent.y, parent.count, width, text, self._start_vf)
+                # Use the call frame count since it might have changed since 'parent' was built
+                vf = VisualFrameNode(self._x, parent.y, parent.cf.count, width, text, self._start_vf)
                 vf.cf = parent.cf
                 self._start_vf.frames.append(vf)
                 self._start_vf = self._start_vf.frames[-1]
@@ -181,21 +329,22 @@ class VisualFrameTree(object):
         return self._start_vf
 
     def _create_vf_children(self, vf, cf):
-        """Create children for 'vf' from 'cf.frames'.
+        """Create children for 'vf' from 'cf.frames'. Only direct children are created.
         """
-        if not cf.frames:
+        cf_frames = cf.sorted_frames
+        if not cf_frames:
             return
 
         x = vf.x + vf.width
         # All calculated widths
-        vf_widths = [calculate_width(c.count, vf.count, vf.width) for c in cf.frames]
+        vf_widths = [calculate_width(c.count, vf.count, vf.width) for c in cf_frames]
         # If at least one children has width == 0
         has_zero_vf = min(vf_widths) == 0
         vf_total_width = sum(vf_widths)
         has_combined = self._with_combined_frames and has_zero_vf
 
         combined_vfs = []
-        for child_cf in sorted(cf.frames, key=lambda c: c.name, reverse=True):
+        for child_cf in reversed(cf_frames):
             child_vf = self._create_vf(x,
                                        vf.y + 1,
                                        vf,
@@ -204,7 +353,6 @@ class VisualFrameTree(object):
             x -= child_vf.width
             # We will combine all vfs with width == 0 in one vf
             if child_vf.width > 0:
-                self._create_vf_children(child_vf, child_cf)
                 vf.frames.append(child_vf)
             else:
                 combined_vfs.append(child_vf)
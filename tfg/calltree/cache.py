@@ -0,0 +1,179 @@
+"""Persistent on-disk cache of parsed call trees.
+A parsed tree is stored as a FrozenCallFrameTree in a simple binary format:
+
+    header - magic, format version, byte order, array item size and typecode,
+             number of nodes, size of the name table.
+    name table - all names encoded as utf-8 and joined with '\\n'.
+    arrays - FrozenCallFrameTree arrays one after another, aligned to the item size.
+
+Cache files are keyed by the input file path, size and modification time plus
+any parameters that affect the tree (e.g. the collapser type). The least recently
+used files are removed once the total cache size goes over the limit.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from tfg.calltree.calltree import FrozenCallFrameTree
+
+
+MAGIC = b'TFGC'
+VERSION = 1
+SUFFIX = '.tfgc'
+DEFAULT_MAX_SIZE = 1 << 30
+# magic, version, byte order, item size, typecode, nodes count, name table size
+_HEADER = struct.Struct('<4sIcBcxQQ')
+_ARRAYS = ('_name_ids', '_parents', '_base_counts', '_counts', '_frames_start', '_frames_count')
+
+
+def default_cache_dir():
+    """Return $XDG_CACHE_HOME/tfg or ~/.cache/tfg.
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'tfg')
+
+
+def _align(offset, size):
+    return (offset + size - 1) // size * size
+
+
+class CallTreeCache(object):
+    """Directory with cached call trees.
+
+    cache_dir - directory to store cache files in. Created on the first store().
+    max_size - maximum total size of all cache files in bytes.
+    """
+    def __init__(self, cache_dir=None, max_size=DEFAULT_MAX_SIZE):
+        self._cache_dir = cache_dir or default_cache_dir()
+        self._max_size = max_size
+
+    def load(self, path, params):
+        """load(self, path: str, params: tuple) -> FrozenCallFrameTree
+        Return the cached tree for the input file or None if there is no valid cache entry.
+        Arrays of the returned tree are backed by a memory mapped cache file, so only the
+        name table is actually read.
+        """
+        try:
+            cache_path = self._cache_path(path, params)
+            with open(cache_path, 'rb') as cache_file:
+                data = mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):
+            return None
+        try:
+            tree = _read_tree(data)
+        except (EnvironmentError, ValueError, TypeError, struct.error):
+            # A broken or incompatible cache file is just a cache miss
+            tree = None
+        if tree is None:
+            return None
+        # Mark the entry as recently used
+        try:
+            os.utime(cache_path, None)
+        except EnvironmentError:
+            pass
+        return tree
+
+    def store(self, path, params, tree):
+        """store(self, path: str, params: tuple, tree: FrozenCallFrameTree)
+        Save the tree for the input file and evict old entries if needed.
+        Failing to write the cache is not an error, the tree just won't be cached.
+        """
+        temp_path = None
+        try:
+            cache_path = self._cache_path(path, params)
+            if not os.path.isdir(self._cache_dir):
+                os.makedirs(self._cache_dir)
+            fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self._cache_dir)
+            with os.fdopen(fd, 'wb') as cache_file:
+                _write_tree(cache_file, tree)
+            os.rename(temp_path, cache_path)
+            temp_path = None
+            self.evict()
+        except EnvironmentError:
+            pass
+        finally:
+            if temp_path is not None:
+                try:
+                    os.remove(temp_path)
+                except EnvironmentError:
+                    pass
+
+    def evict(self):
+        """Remove the least recently used cache files until the total size fits max_size.
+        """
+        entries = []
+        for name in os.listdir(self._cache_dir):
+            if not name.endswith(SUFFIX):
+                continue
+            entry_path = os.path.join(self._cache_dir, name)
+            try:
+                entry_stat = os.stat(entry_path)
+            except EnvironmentError:
+                continue
+            entries.append((entry_stat.st_mtime, entry_stat.st_size, entry_path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries):
+            if total_size <= self._max_size:
+                break
+            try:
+                os.remove(entry_path)
+            except EnvironmentError:
+                continue
+            total_size -= size
+
+    def _cache_path(self, path, params):
+        """Return a cache file path for the input file.
+        Raise EnvironmentError if the input file doesn't exist.
+        """
+        input_stat = os.stat(path)
+        mtime = getattr(input_stat, 'st_mtime_ns', input_stat.st_mtime)
+        key = repr((VERSION, os.path.abspath(path), input_stat.st_size, mtime, tuple(params)))
+        return os.path.join(self._cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + SUFFIX)
+
+
+def _write_tree(cache_file, tree):
+    names = '\n'.join(tree._names).encode('utf-8')
+    typecode = tree._counts.typecode
+    itemsize = tree._counts.itemsize
+    cache_file.write(_HEADER.pack(MAGIC, VERSION, sys.byteorder[0].encode('ascii'), itemsize,
+                                  typecode.encode('ascii'), len(tree), len(names)))
+    cache_file.write(names)
+    offset = _HEADER.size + len(names)
+    cache_file.write(b'\0' * (_align(offset, itemsize) - offset))
+    for attr in _ARRAYS:
+        getattr(tree, attr).tofile(cache_file)
+
+
+def _read_tree(data):
+    """Return a FrozenCallFrameTree backed by 'data' or None if 'data' is not a valid cache file.
+    """
+    if len(data) < _HEADER.size:
+        return None
+    magic, version, byteorder, itemsize, typecode, nodes, names_size = \
+        _HEADER.unpack_from(data, 0)
+    typecode = typecode.decode('ascii')
+    if magic != MAGIC or version != VERSION or byteorder != sys.byteorder[0].encode('ascii') or \
+            typecode not in ('q', 'l') or array(typecode).itemsize != itemsize:
+        return None
+    offset = _align(_HEADER.size + names_size, itemsize)
+    if len(data) != offset + nodes * itemsize * len(_ARRAYS):
+        return None
+    names = data[_HEADER.size:_HEADER.size + names_size].decode('utf-8').split('\n')
+    arrays = []
+    try:
+        view = memoryview(data)
+    except TypeError:
+        # Python 2 can't make a memoryview of an mmap
+        view = None
+    for _ in _ARRAYS:
+        end = offset + nodes * itemsize
+        if view is not None and hasattr(view, 'cast'):
+            arrays.append(view[offset:end].cast(typecode))
+        else:
+            arrays.append(array(typecode, data[offset:end]))
+        offset = end
+    return FrozenCallFrameTree.from_arrays(names, *arrays)
@@ -1,6 +1,270 @@
 """Call frames stack represenation as a tree.
 """
 
+import sys
+from array import array
+
+
+# Number of lines joined into a single write() by write_collapsed()
+WRITE_BLOCK_LINES = 4096
+# Name of the frame that pruned frames are folded into. See CallFrameTree.prune().
+PRUNED = '[pruned]'
+
+
+def _count_array():
+    """Return an empty array for sample counts and node indexes.
+    Use 64-bit items where the platform supports them.
+    """
+    try:
+        return array('q')
+    except ValueError:
+        return array('l')
+
+
+def collapsed_stacks(head, counts=None):
+    """collapsed_stacks(head: CallFrameNode, counts: function) -> iterator[(list[str], int)]
+    Yield (frames, base_count) for every frame under 'head' with base_count > 0.
+    Children are visited in the name order, so the output doesn't depend on the
+    order the stacks were added in.
+
+    counts - function that returns what to yield instead of base_count for a frame.
+        Frames for which it returns None are skipped.
+    """
+    callstack = []
+    # Pending (depth, frame) pairs. Children are pushed in reverse so they're
+    # popped in the name order.
+    pending = [(0, head)]
+    while pending:
+        depth, cf = pending.pop()
+        if depth > 0:
+            del callstack[depth - 1:]
+            callstack.append(cf.name)
+        if counts is not None:
+            frame_counts = counts(cf)
+            if frame_counts is not None:
+                yield callstack[:], frame_counts
+        # Only original top call frames have base_count > 0
+        elif cf.base_count > 0:
+            yield callstack[:], cf.base_count
+        pending.extend((depth + 1, child_cf) for child_cf in reversed(cf.sorted_frames))
+
+
+def write_collapsed(stacks, output_file=None):
+    """write_collapsed(stacks: iterable[(list[str], object)], output_file: file)
+    Write stacks as 'frame;frame;frame count' lines to 'output_file' (stdout by default).
+    'count' is written with str(). Lines are written in blocks of WRITE_BLOCK_LINES, so
+    writing doesn't cost a call per line.
+    """
+    if output_file is None:
+        output_file = sys.stdout
+    lines = []
+    for frames, count in stacks:
+        lines.append('{} {}\n'.format(';'.join(frames), count))
+        if len(lines) >= WRITE_BLOCK_LINES:
+            output_file.write(''.join(lines))
+            lines = []
+    if lines:
+        output_file.write(''.join(lines))
+
+
+def inverted_stacks(head, counts=None):
+    """inverted_stacks(head: CallFrameNode, counts: function) -> iterator[(list[str], int)]
+    Same as collapsed_stacks() but every stack is reversed: the frame a sample was taken in
+    goes first.
+    """
+    for frames, count in collapsed_stacks(head, counts):
+        frames.reverse()
+        yield frames, count
+
+
+def _inverted_tree(frozen_tree):
+    """_inverted_tree(frozen_tree: FrozenCallFrameTree) -> FrozenCallFrameTree
+    Build the inverted tree in a single pass over the 'frozen_tree' nodes. Works with node
+    indexes only, so no node objects are created.
+    """
+    names = frozen_tree._names
+    names_count = len(names)
+    name_ids = frozen_tree._name_ids
+    parents = frozen_tree._parents
+    base_counts = frozen_tree._base_counts
+    # Inverted tree nodes in the creation order. Node 0 is the head.
+    inv_name_ids = [name_ids[0]]
+    inv_parents = [-1]
+    inv_base_counts = [0]
+    inv_counts = [0]
+    # parent * len(names) + name id -> node
+    index = {}
+    for i in range(1, len(frozen_tree)):
+        count = base_counts[i]
+        if count == 0:
+            continue
+        inv_counts[0] += count
+        # Go from the frame the samples were taken in down to the head
+        node = 0
+        j = i
+        while j > 0:
+            name_id = name_ids[j]
+            key = node * names_count + name_id
+            child = index.get(key)
+            if child is None:
+                child = index[key] = len(inv_parents)
+                inv_name_ids.append(name_id)
+                inv_parents.append(node)
+                inv_base_counts.append(0)
+                inv_counts.append(count)
+            else:
+                inv_counts[child] += count
+            node = child
+            j = parents[j]
+        inv_base_counts[node] += count
+    index = None
+
+    # Lay the nodes out like FrozenCallFrameTree does: in the breadth-first order with
+    # children sorted by name.
+    name_ranks = [0] * names_count
+    for rank, name_id in enumerate(sorted(range(names_count), key=names.__getitem__)):
+        name_ranks[name_id] = rank
+    children = [[] for _ in inv_parents]
+    for node in range(1, len(inv_parents)):
+        children[inv_parents[node]].append(node)
+    order = [0]
+    frames_start = []
+    frames_count = []
+    for node in order:
+        node_children = children[node]
+        if len(node_children) > 1:
+            node_children.sort(key=lambda child: name_ranks[inv_name_ids[child]])
+        frames_start.append(len(order))
+        frames_count.append(len(node_children))
+        order.extend(node_children)
+    children = None
+    positions = [0] * len(order)
+    for position, node in enumerate(order):
+        positions[node] = position
+    positions.append(-1)
+
+    arrays = []
+    for values in ([inv_name_ids[node] for node in order],
+                   [positions[inv_parents[node]] for node in order],
+                   [inv_base_counts[node] for node in order],
+                   [inv_counts[node] for node in order],
+                   frames_start,
+                   frames_count):
+        arrays.append(_count_array())
+        arrays[-1].fromlist(values)
+    return FrozenCallFrameTree.from_arrays(names, *arrays)
+
+
+def merge_frozen_trees(trees):
+    """merge_frozen_trees(trees: list[FrozenCallFrameTree]) -> FrozenCallFrameTree
+    Merge all trees in a single one in a single breadth-first pass over their nodes. Works
+    with node indexes only, so no node objects are created and it takes time proportional
+    to the total number of nodes.
+    """
+    if len(trees) == 1:
+        return trees[0]
+    names = []
+    name_index = {}
+    # Name id in a tree -> name id in the merged tree, for every tree
+    id_maps = []
+    for tree in trees:
+        id_map = []
+        for name in tree._names:
+            name_id = name_index.get(name)
+            if name_id is None:
+                name_id = name_index[name] = len(names)
+                names.append(name)
+            id_map.append(name_id)
+        id_maps.append(id_map)
+    name_index = None
+    name_ranks = [0] * len(names)
+    for rank, name_id in enumerate(sorted(range(len(names)), key=names.__getitem__)):
+        name_ranks[name_id] = rank
+
+    # (tree, node) pairs merged into every node of the merged tree, in the breadth-first order
+    order = [[(tree, 0) for tree in range(len(trees))]]
+    name_ids = [id_maps[0][trees[0]._name_ids[0]]]
+    parents = [-1]
+    base_counts = []
+    counts = []
+    frames_start = []
+    frames_count = []
+    for node, sources in enumerate(order):
+        if len(sources) == 1:
+            # Only one tree has the node, so its children are already sorted and unique
+            tree_id, i = sources[0]
+            tree = trees[tree_id]
+            base_counts.append(tree._base_counts[i])
+            counts.append(tree._counts[i])
+            start = tree._frames_start[i]
+            end = start + tree._frames_count[i]
+            frames_start.append(len(order))
+            frames_count.append(end - start)
+            id_map = id_maps[tree_id]
+            tree_name_ids = tree._name_ids
+            for child in range(start, end):
+                order.append(((tree_id, child),))
+                name_ids.append(id_map[tree_name_ids[child]])
+                parents.append(node)
+            order[node] = None
+            continue
+        base_count = count = 0
+        # Merged name id -> (tree, node) pairs of the children with that name
+        children = {}
+        for tree_id, i in sources:
+            tree = trees[tree_id]
+            base_count += tree._base_counts[i]
+            count += tree._counts[i]
+            id_map = id_maps[tree_id]
+            tree_name_ids = tree._name_ids
+            start = tree._frames_start[i]
+            for child in range(start, start + tree._frames_count[i]):
+                name_id = id_map[tree_name_ids[child]]
+                child_sources = children.get(name_id)
+                if child_sources is None:
+                    children[name_id] = [(tree_id, child)]
+                else:
+                    child_sources.append((tree_id, child))
+        base_counts.append(base_count)
+        counts.append(count)
+        frames_start.append(len(order))
+        frames_count.append(len(children))
+        for name_id in sorted(children, key=name_ranks.__getitem__):
+            order.append(children[name_id])
+            name_ids.append(name_id)
+            parents.append(node)
+        # The sources are not needed anymore, so let them go as soon as possible
+        order[node] = None
+    order = None
+
+    arrays = []
+    for values in (name_ids, parents, base_counts, counts, frames_start, frames_count):
+        arrays.append(_count_array())
+        arrays[-1].fromlist(values)
+    return FrozenCallFrameTree.from_arrays(names, *arrays)
+
+
+def total_count(frames):
+    """total_count(frames: list[CallFrameNode]) -> int
+    Return the number of samples in 'frames'. Samples of a frame that is called (directly
+    or not) from another frame in 'frames' are only counted once.
+    """
+    frames_set = set(frames)
+    # Frames that don't have any of 'frames' among their ancestors
+    unmatched = set()
+    total = 0
+    for cf in frames:
+        path = []
+        parent = cf.parent
+        while parent is not None and parent not in unmatched and parent not in frames_set:
+            path.append(parent)
+            parent = parent.parent
+        if parent is None or parent in unmatched:
+            unmatched.update(path)
+            total += cf.count
+    return total
+
+
 class CallFrameNode(object):
     """Stack frame node.
     Represent a single stack frame.
@@ -9,7 +273,12 @@ class CallFrameNode(object):
     frames - children stack frames.
     base_count - original sample count for the this node.
     count - samle count for all children. Useful to calculate the 'weight' of the node.
+
+    Children are kept both in the 'frames' list (insertion order) and in a name -> node
+    index, so looking up a child by name doesn't depend on the number of children.
+    Use add_frame() to add a child so both stay in sync.
     """
+    __slots__ = ('name', 'frames', '_frames_index', 'base_count', 'count', 'parent')
 
     def __init__(self, name, frames=None, base_count=0, count=0, parent=None):
         """__init__(self, name: str, frames: list[CallFrameNode], base_count: int, count: int)
@@ -19,10 +288,32 @@ class CallFrameNode(object):
             self.frames = []
         else:
             self.frames = frames[:]
+        self._frames_index = dict((frame.name, frame) for frame in self.frames)
         self.base_count = base_count
         self.count = count
         self.parent = parent
 
+    def get_frame(self, name):
+        """get_frame(self, name: str) -> CallFrameNode
+        Return a child frame with the 'name' or None if there is no such child.
+        """
+        return self._frames_index.get(name)
+
+    def add_frame(self, name):
+        """add_frame(self, name: str) -> CallFrameNode
+        Create a new child frame with the 'name' and return it.
+        """
+        frame = CallFrameNode(name, parent=self)
+        self.frames.append(frame)
+        self._frames_index[name] = frame
+        return frame
+
+    @property
+    def sorted_frames(self):
+        """Children stack frames sorted by name.
+        """
+        return sorted(self.frames, key=lambda cf: cf.name)
+
     def __repr__(self):
         return 'CallFrameNode(name={}, base_count={}, count={})'.format(
             self.name, self.base_count, self.count)
@@ -50,13 +341,112 @@ class CallFrameTree(object):
     """
     def __init__(self):
         self._head = CallFrameNode('all')
+        # name -> [CallFrameNode]. Built on demand and dropped once new frames are added.
+        self._names_index = None
+        # Inverted tree. Built on demand and dropped once stacks are added or pruned.
+        self._inverted = None
 
     def add_stack(self, frames, count):
         """add_stack(self, frames: list[str], count: int)
         Add frames to the tree with sample count.
         """
+        self._inverted = None
         self._head.count += count
-        self._insert_frame(self._head, frames, count)
+        frame = self._head
+        for name in frames:
+            child = frame._frames_index.get(name)
+            if child is None:
+                child = frame.add_frame(name)
+                self._names_index = None
+            child.count += count
+            frame = child
+        # Save the original base_count for the top frame
+        if frame is not self._head:
+            frame.base_count += count
+
+    def add_stacks(self, stacks):
+        """add_stacks(self, stacks: iterable[(list[str], int)])
+        Add every (frames, count) pair from 'stacks' to the tree.
+        'stacks' is consumed lazily, so it can be a collapser's parse() generator: each stack
+        is added to the tree as soon as it's parsed and is never kept around afterwards.
+        """
+        for frames, count in stacks:
+            self.add_stack(frames, count)
+
+    def merge(self, other):
+        """merge(self, other: CallFrameTree | FrozenCallFrameTree)
+        Add all stacks from the 'other' tree to this tree.
+        Takes time proportional to the number of nodes in 'other' rather than to the
+        number of samples.
+        """
+        self._head.count += other.head.count
+        self._head.base_count += other.head.base_count
+        self._names_index = None
+        self._inverted = None
+        if isinstance(other, FrozenCallFrameTree):
+            # Nodes are stored in the breadth-first order, so a parent is always merged
+            # before its children.
+            nodes = [self._head]
+            for i in range(1, len(other)):
+                parent = nodes[other._parents[i]]
+                name = other._names[other._name_ids[i]]
+                frame = parent._frames_index.get(name)
+                if frame is None:
+                    frame = parent.add_frame(name)
+                frame.count += other._counts[i]
+                frame.base_count += other._base_counts[i]
+                nodes.append(frame)
+            return
+
+        pending = [(self._head, other.head)]
+        while pending:
+            frame, other_frame = pending.pop()
+            for other_child in other_frame.frames:
+                child = frame._frames_index.get(other_child.name)
+                if child is None:
+                    child = frame.add_frame(other_child.name)
+                child.count += other_child.count
+                child.base_count += other_child.base_count
+                pending.append((child, other_child))
+
+    def prune(self, min_count=0, max_depth=None):
+        """prune(self, min_count: int, max_depth: int)
+        Remove frames with count < min_count and frames deeper than max_depth (children of
+        the head have depth 1). Samples of removed frames are added to the PRUNED child
+        of their parent, so counts of all remaining frames stay the same.
+        The head and PRUNED frames are never removed.
+        """
+        self._inverted = None
+        pending = [(self._head, 0)]
+        removed = []
+        while pending:
+            frame, depth = pending.pop()
+            kept = []
+            pruned_count = 0
+            for child in frame.frames:
+                if child.name != PRUNED and (child.count < min_count or
+                                             (max_depth is not None and depth >= max_depth)):
+                    pruned_count += child.count
+                    del frame._frames_index[child.name]
+                    removed.append(child)
+                else:
+                    kept.append(child)
+            if pruned_count:
+                frame.frames = kept
+                pruned = frame._frames_index.get(PRUNED)
+                if pruned is None:
+                    pruned = frame.add_frame(PRUNED)
+                pruned.count += pruned_count
+                pruned.base_count += pruned_count
+                self._names_index = None
+            pending.extend((child, depth + 1) for child in kept)
+
+        # Parent links make cycles, so the removed frames would only be released by the
+        # garbage collector. Without them the frames are released right away.
+        while removed:
+            frame = removed.pop()
+            frame.parent = None
+            removed.extend(frame.frames)
 
     @property
     def head(self):
@@ -64,36 +454,246 @@ class CallFrameTree(object):
         """
         return self._head
 
-    def dump(self):
-        """Dump tree to stdout.
+    def inverted(self):
+        """inverted(self) -> FrozenCallFrameTree
+        Return the inverted (callee-rooted) tree: all stacks are reversed, so children of
+        the head are the frames samples were taken in. Calling inverted() on the result
+        returns this tree back.
+        The inverted tree is built once, so all stacks should be added before calling it.
+        """
+        if self._inverted is None:
+            self._inverted = _inverted_tree(self.freeze())
+            self._inverted._inverted = self
+        return self._inverted
+
+    def find_frames(self, regex):
+        """find_frames(self, regex: re.Pattern) -> list[CallFrameNode]
+        Return all frames with a name matching 'regex'.
+        The regex is matched only once per distinct frame name.
+        """
+        if self._names_index is None:
+            self._names_index = {}
+            pending = [self._head]
+            while pending:
+                cf = pending.pop()
+                self._names_index.setdefault(cf.name, []).append(cf)
+                pending.extend(cf.frames)
+        frames = []
+        for name, cfs in self._names_index.items():
+            if regex.search(name):
+                frames.extend(cfs)
+        return frames
+
+    def dump(self, output_file=None):
+        """dump(self, output_file: file)
+        Dump tree to 'output_file' (stdout by default).
         This should produce the same output as any stackcollapse*.pl from
-        https://github.com/brendangregg/FlameGraph.
+        https://github.com/brendangregg/FlameGraph. Stacks are sorted by frame names, so
+        the output doesn't depend on the order of stacks in the input file.
         """
-        self._dump(self._head, [])
+        write_collapsed(collapsed_stacks(self._head), output_file)
 
-    def _dump(self, cf, callstack):
-        # Only original top call frames have base_count > 0
-        if cf.base_count > 0:
-            print('{} {}'.format(';'.join(f.name for f in callstack), cf.base_count))
-        for child_cf in cf.frames:
-            callstack.append(child_cf)
-            self._dump(child_cf, callstack)
-            callstack.pop()
-
-    def _insert_frame(self, start_frame, frames, count):
-        if not frames:
-            return
-        frame = self._get_or_create_frame(start_frame, frames)
-        frame.count += count
-        # Save the original base_count
-        if len(frames) == 1:
-            frame.base_count += count
-        self._insert_frame(frame, frames[1:], count)
+    def freeze(self):
+        """freeze(self) -> FrozenCallFrameTree
+        Convert the tree into a compact read-only FrozenCallFrameTree.
+        Should be called once all stacks are added. The tree itself is left intact, so
+        drop the reference to it to release the memory.
+        """
+        return FrozenCallFrameTree(self)
 
-    def _get_or_create_frame(self, start_frame, frames):
-        for frame in start_frame.frames:
-            if frame.name == frames[0]:
-                return frame
-        else:
-            start_frame.frames.append(CallFrameNode(frames[0], parent=start_frame))
-            return start_frame.frames[-1]
+
+class FrozenCallFrameNode(object):
+    """Read-only view of a single FrozenCallFrameTree node.
+    Provides the same attributes as CallFrameNode. Views are created on demand, so
+    compare them with '==' rather than 'is'.
+    """
+    __slots__ = ('_tree', '_index')
+
+    def __init__(self, tree, index):
+        """__init__(self, tree: FrozenCallFrameTree, index: int)
+        """
+        self._tree = tree
+        self._index = index
+
+    @property
+    def name(self):
+        return self._tree._names[self._tree._name_ids[self._index]]
+
+    @property
+    def base_count(self):
+        return self._tree._base_counts[self._index]
+
+    @property
+    def count(self):
+        return self._tree._counts[self._index]
+
+    @property
+    def parent(self):
+        parent = self._tree._parents[self._index]
+        return FrozenCallFrameNode(self._tree, parent) if parent >= 0 else None
+
+    @property
+    def frames(self):
+        """Children stack frames. Always sorted by name.
+        """
+        tree = self._tree
+        start = tree._frames_start[self._index]
+        return [FrozenCallFrameNode(tree, i)
+                for i in range(start, start + tree._frames_count[self._index])]
+
+    @property
+    def sorted_frames(self):
+        return self.frames
+
+    def get_frame(self, name):
+        """get_frame(self, name: str) -> FrozenCallFrameNode
+        Return a child frame with the 'name' or None if there is no such child.
+        """
+        tree = self._tree
+        lo = tree._frames_start[self._index]
+        hi = lo + tree._frames_count[self._index]
+        # Children are sorted by name, so use a binary search
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if tree._names[tree._name_ids[mid]] < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < tree._frames_start[self._index] + tree._frames_count[self._index] and \
+                tree._names[tree._name_ids[lo]] == name:
+            return FrozenCallFrameNode(tree, lo)
+        return None
+
+    def __eq__(self, other):
+        return isinstance(other, FrozenCallFrameNode) and \
+            self._tree is other._tree and self._index == other._index
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._index)
+
+    def __repr__(self):
+        return 'FrozenCallFrameNode(name={}, base_count={}, count={})'.format(
+            self.name, self.base_count, self.count)
+
+
+class FrozenCallFrameTree(object):
+    """Compact read-only representation of a CallFrameTree.
+    Instead of a Python object per node, nodes are stored in parallel arrays and
+    referenced by their index:
+
+    _names - interned string table. Every distinct frame name is stored once.
+    _name_ids - index of the node name in _names.
+    _parents - index of the parent node (-1 for the head node).
+    _base_counts, _counts - see CallFrameNode.
+    _frames_start, _frames_count - children range. Nodes are stored in the breadth-first
+        order with children of a node stored next to each other and sorted by name, so
+        children of the node i are [_frames_start[i], _frames_start[i] + _frames_count[i]).
+
+    The head node has index 0. Use CallFrameTree.freeze() to create a frozen tree.
+    """
+    def __init__(self, call_tree):
+        """__init__(self, call_tree: CallFrameTree)
+        """
+        self._names = []
+        self._name_ids = _count_array()
+        self._parents = _count_array()
+        self._base_counts = _count_array()
+        self._counts = _count_array()
+        self._frames_start = _count_array()
+        self._frames_count = _count_array()
+
+        name_ids = {}
+        order = [call_tree.head]
+        self._parents.append(-1)
+        i = 0
+        while i < len(order):
+            cf = order[i]
+            name_id = name_ids.get(cf.name)
+            if name_id is None:
+                name_id = name_ids[cf.name] = len(self._names)
+                self._names.append(cf.name)
+            self._name_ids.append(name_id)
+            self._base_counts.append(cf.base_count)
+            self._counts.append(cf.count)
+            children = cf.sorted_frames
+            self._frames_start.append(len(order))
+            self._frames_count.append(len(children))
+            order.extend(children)
+            self._parents.extend(i for _ in children)
+            # The node is not needed anymore, so let it go as soon as possible
+            order[i] = None
+            i += 1
+        self._names_index = None
+        self._inverted = None
+
+    @classmethod
+    def from_arrays(cls, names, name_ids, parents, base_counts, counts, frames_start, frames_count):
+        """from_arrays(cls, names: list[str], name_ids, parents, base_counts, counts,
+                       frames_start, frames_count) -> FrozenCallFrameTree
+        Create a tree from already built arrays (e.g. loaded from a file). Arrays could be
+        any sequences of integers that support indexing.
+        """
+        tree = cls.__new__(cls)
+        tree._names = names
+        tree._name_ids = name_ids
+        tree._parents = parents
+        tree._base_counts = base_counts
+        tree._counts = counts
+        tree._frames_start = frames_start
+        tree._frames_count = frames_count
+        tree._names_index = None
+        tree._inverted = None
+        return tree
+
+    @property
+    def head(self):
+        """Head node.
+        """
+        return FrozenCallFrameNode(self, 0)
+
+    def __len__(self):
+        """Number of nodes in the tree.
+        """
+        return len(self._counts)
+
+    @property
+    def names(self):
+        """All distinct frame names.
+        """
+        return self._names
+
+    def inverted(self):
+        """inverted(self) -> FrozenCallFrameTree
+        See CallFrameTree.inverted().
+        """
+        if self._inverted is None:
+            self._inverted = _inverted_tree(self)
+            self._inverted._inverted = self
+        return self._inverted
+
+    def find_frames(self, regex):
+        """find_frames(self, regex: re.Pattern) -> list[FrozenCallFrameNode]
+        See CallFrameTree.find_frames().
+        """
+        if self._names_index is None:
+            # name id -> indexes of the nodes with that name
+            self._names_index = [_count_array() for _ in self._names]
+            for i, name_id in enumerate(self._name_ids):
+                self._names_index[name_id].append(i)
+        frames = []
+        for name_id, name in enumerate(self._names):
+            if regex.search(name):
+                frames.extend(FrozenCallFrameNode(self, i) for i in self._names_index[name_id])
+        return frames
+
+    def dump(self, output_file=None):
+        """dump(self, output_file: file)
+        See CallFrameTree.dump().
+        """
+        write_collapsed(collapsed_stacks(self.head), output_file)
+
+    def freeze(self):
+        return self
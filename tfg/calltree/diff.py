@@ -0,0 +1,156 @@
+"""Differential call frames tree.
+Compare two profiles (e.g. captured before and after a change) frame by frame.
+"""
+
+from tfg.calltree.calltree import CallFrameNode, CallFrameTree, collapsed_stacks, write_collapsed
+
+
+class DiffCallFrameNode(CallFrameNode):
+    """Stack frame node of a DiffCallFrameTree.
+    'base_count' and 'count' come from the new profile (see CallFrameNode).
+
+    old_base_count, old_count - the same counts from the old profile.
+    """
+    __slots__ = ('old_base_count', 'old_count')
+
+    def __init__(self, name, parent=None):
+        """__init__(self, name: str, parent: DiffCallFrameNode)
+        """
+        CallFrameNode.__init__(self, name, parent=parent)
+        self.old_base_count = 0
+        self.old_count = 0
+
+    def add_frame(self, name):
+        """add_frame(self, name: str) -> DiffCallFrameNode
+        Create a new child frame with the 'name' and return it.
+        """
+        frame = DiffCallFrameNode(name, parent=self)
+        self.frames.append(frame)
+        self._frames_index[name] = frame
+        return frame
+
+    def __repr__(self):
+        return 'DiffCallFrameNode(name={}, old_count={}, count={})'.format(
+            self.name, self.old_count, self.count)
+
+
+class DiffCallFrameTree(CallFrameTree):
+    """Union of two call frame trees: the old profile and the new one.
+    Frame widths are taken from the new profile, like in difffolded.pl from
+    https://github.com/brendangregg/FlameGraph. Frames that are only in the old profile
+    have count == 0.
+
+    Profiles usually have different number of samples, so frames are compared by their
+    share of all samples in a profile (see delta()).
+    """
+    def __init__(self, old_tree, new_tree):
+        """__init__(self, old_tree: CallFrameTree, new_tree: CallFrameTree)
+        Both trees could also be FrozenCallFrameTree. They're kept to build the inverted
+        tree, so they shouldn't be changed afterwards.
+        """
+        CallFrameTree.__init__(self)
+        self._head = DiffCallFrameNode('all')
+        self._old_tree = old_tree
+        self._new_tree = new_tree
+        self._old_total = old_tree.head.count
+        self._new_total = new_tree.head.count
+        self._max_delta = 0.0
+        self._merge(old_tree.head, new_tree.head)
+
+    def _merge(self, old_head, new_head):
+        """Walk both trees at once and create a node for every frame from any of them.
+        Children of both trees are sorted by name, so they're merged like two sorted lists.
+        """
+        pending = [(self._head, old_head, new_head)]
+        while pending:
+            frame, old_cf, new_cf = pending.pop()
+            old_frames = []
+            if old_cf is not None:
+                frame.old_base_count = old_cf.base_count
+                frame.old_count = old_cf.count
+                old_frames = old_cf.sorted_frames
+            new_frames = []
+            if new_cf is not None:
+                frame.base_count = new_cf.base_count
+                frame.count = new_cf.count
+                new_frames = new_cf.sorted_frames
+            self._max_delta = max(self._max_delta, abs(self.delta(frame)))
+
+            i = j = 0
+            while i < len(old_frames) or j < len(new_frames):
+                old_name = old_frames[i].name if i < len(old_frames) else None
+                new_name = new_frames[j].name if j < len(new_frames) else None
+                if new_name is None or (old_name is not None and old_name < new_name):
+                    pending.append((frame.add_frame(old_name), old_frames[i], None))
+                    i += 1
+                elif old_name is None or new_name < old_name:
+                    pending.append((frame.add_frame(new_name), None, new_frames[j]))
+                    j += 1
+                else:
+                    pending.append((frame.add_frame(new_name), old_frames[i], new_frames[j]))
+                    i += 1
+                    j += 1
+
+    def delta(self, cf):
+        """delta(self, cf: DiffCallFrameNode) -> float
+        Return how the share of all samples in 'cf' changed in the new profile: a value
+        in [-1, 1] (e.g. 0.1 if it went from 20% to 30%).
+        """
+        return self.ratio(cf.count, cf.old_count)
+
+    def self_delta(self, cf):
+        """self_delta(self, cf: DiffCallFrameNode) -> float
+        Same as delta() but for 'base_count'.
+        """
+        return self.ratio(cf.base_count, cf.old_base_count)
+
+    def ratio(self, new_count, old_count):
+        """ratio(self, new_count: int, old_count: int) -> float
+        Return new_count / new total - old_count / old total.
+        """
+        new_ratio = float(new_count) / self._new_total if self._new_total else 0.0
+        old_ratio = float(old_count) / self._old_total if self._old_total else 0.0
+        return new_ratio - old_ratio
+
+    def inverted(self):
+        """inverted(self) -> DiffCallFrameTree
+        Return the inverted differential tree. See CallFrameTree.inverted().
+        """
+        if self._inverted is None:
+            # Inverted trees of both profiles are built without going through their stacks
+            self._inverted = DiffCallFrameTree(self._old_tree.inverted(), self._new_tree.inverted())
+            self._inverted._inverted = self
+        return self._inverted
+
+    @property
+    def max_delta(self):
+        """The biggest absolute delta() of all frames.
+        """
+        return self._max_delta
+
+    @property
+    def old_total(self):
+        return self._old_total
+
+    def dump(self, output_file=None):
+        """dump(self, output_file: file)
+        Dump tree to 'output_file' (stdout by default).
+        This should produce the same output as difffolded.pl from
+        https://github.com/brendangregg/FlameGraph: 'frames old_count new_count'.
+        """
+        write_collapsed(((frames, '{} {}'.format(old_count, new_count))
+                         for frames, (old_count, new_count)
+                         in collapsed_stacks(self._head, self._counts)), output_file)
+
+    @staticmethod
+    def _counts(cf):
+        """Stacks of the both profiles for collapsed_stacks().
+        """
+        if cf.base_count > 0 or cf.old_base_count > 0:
+            return cf.old_base_count, cf.base_count
+        return None
+
+    def freeze(self):
+        """Differential trees can't be frozen, so the tree itself is returned.
+        """
+        return self
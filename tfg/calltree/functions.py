@@ -0,0 +1,62 @@
+"""Per-function statistics of a call tree.
+"""
+
+
+class FunctionStats(object):
+    """Samples of all frames of a single function.
+
+    name - function (frame) name.
+    self_count - sum of 'base_count' of all frames of the function.
+    total_count - number of samples with the function anywhere on the stack. Recursive
+        calls are counted once: frames called from another frame of the same function
+        don't add to the total.
+    hottest - the frame of the function with the biggest 'count'.
+    """
+    __slots__ = ('name', 'self_count', 'total_count', 'hottest')
+
+    def __init__(self, name, hottest):
+        """__init__(self, name: str, hottest: CallFrameNode)
+        """
+        self.name = name
+        self.self_count = 0
+        self.total_count = 0
+        self.hottest = hottest
+
+    def __repr__(self):
+        return 'FunctionStats(name={}, self_count={}, total_count={})'.format(
+            self.name, self.self_count, self.total_count)
+
+
+def function_stats(head):
+    """function_stats(head: CallFrameNode) -> list[FunctionStats]
+    Return statistics for every function under 'head' (the head itself isn't included).
+    The tree is walked once. While walking, the number of frames of every function on the
+    current path is kept, so a frame only adds to the total if its function is not
+    already on the path.
+    """
+    stats = {}
+    # name -> number of frames with the name on the current path
+    active = {}
+    path = []
+    # Frames to visit. None means that all children of path[-1] were visited.
+    pending = list(head.frames)
+    while pending:
+        cf = pending.pop()
+        if cf is None:
+            active[path.pop().name] -= 1
+            continue
+        name = cf.name
+        function = stats.get(name)
+        if function is None:
+            function = stats[name] = FunctionStats(name, cf)
+        elif cf.count > function.hottest.count:
+            function.hottest = cf
+        function.self_count += cf.base_count
+        depth = active.get(name, 0)
+        if depth == 0:
+            function.total_count += cf.count
+        active[name] = depth + 1
+        path.append(cf)
+        pending.append(None)
+        pending.extend(cf.frames)
+    return list(stats.values())
@@ -0,0 +1,66 @@
+"""Per-source sample counts of a call tree merged from several profiles.
+E.g. when the same workload is profiled on many hosts and all profiles are merged in a
+single tree, SourceCounts tells how samples of a frame are distributed between hosts.
+"""
+
+from tfg.calltree.calltree import CallFrameTree, FrozenCallFrameTree, merge_frozen_trees
+
+
+def merge_trees(trees):
+    """merge_trees(trees: list[CallFrameTree | FrozenCallFrameTree]) -> FrozenCallFrameTree
+    Merge all trees in a single one. Takes time proportional to the total number of nodes
+    rather than to the number of samples. Frozen trees are merged without building a
+    CallFrameTree.
+    """
+    if len(trees) == 1:
+        return trees[0].freeze()
+    if all(isinstance(tree, FrozenCallFrameTree) for tree in trees):
+        return merge_frozen_trees(trees)
+    call_tree = CallFrameTree()
+    for tree in trees:
+        call_tree.merge(tree)
+    return call_tree.freeze()
+
+
+class SourceCounts(object):
+    """Sample counts of frames of a merged tree in every source tree.
+    Source trees are kept as they are (usually they're compact FrozenCallFrameTree), and a
+    frame is looked up in them by the names of its path only when its counts are needed.
+
+    call_tree - the merged tree.
+    """
+    def __init__(self, call_tree, sources, trees):
+        """__init__(self, call_tree: FrozenCallFrameTree, sources: list[str],
+                    trees: list[FrozenCallFrameTree])
+        sources - names of the sources (e.g. input file names) in the same order as 'trees'.
+        """
+        self.call_tree = call_tree
+        self._sources = sources
+        self._trees = trees
+
+    def __len__(self):
+        """Number of sources.
+        """
+        return len(self._trees)
+
+    def counts(self, cf):
+        """counts(self, cf: FrozenCallFrameNode) -> list[(str, int)]
+        Return (source, count) pairs for every source that has samples in the frame 'cf' of
+        the merged tree. The biggest counts go first.
+        """
+        names = []
+        while cf.parent is not None:
+            names.append(cf.name)
+            cf = cf.parent
+        names.reverse()
+        counts = []
+        for source, tree in zip(self._sources, self._trees):
+            frame = tree.head
+            for name in names:
+                frame = frame.get_frame(name)
+                if frame is None:
+                    break
+            if frame is not None and frame.count > 0:
+                counts.append((source, frame.count))
+        counts.sort(key=lambda source_count: (-source_count[1], source_count[0]))
+        return counts
@@ -0,0 +1,170 @@
+"""Samples of a profile grouped by time, so the call tree of any time window can be built
+without parsing the input file again.
+
+Every time bucket keeps its own frozen call tree. Frozen trees are merged array to array,
+so the tree of a window is the merge of the trees of its buckets and takes time proportional
+to their number of nodes rather than to the number of samples in the window.
+"""
+
+from tfg.calltree.calltree import CallFrameTree, merge_frozen_trees
+from tfg.calltree.sources import merge_trees
+
+
+# The number of buckets is kept under that by making buckets wider as the profile grows.
+MAX_BUCKETS = 128
+# Width of a bucket in seconds before any widening.
+INITIAL_BUCKET_WIDTH = 0.001
+
+
+class TimelineBuilder(object):
+    """Add timestamped stacks to per-bucket call trees.
+
+    Buckets start INITIAL_BUCKET_WIDTH seconds wide at the timestamp of the first stack.
+    When the stacks span more than 'max_buckets' buckets, the bucket width is doubled and
+    every two neighbouring buckets are merged. So the number of buckets (and the memory they
+    take) is bounded however long the profile is.
+
+    Only the buckets stacks are being added to are kept as mutable CallFrameTrees. They're
+    frozen once a stack of a later bucket than all of them shows up, so stacks should be
+    mostly sorted by time (like 'perf script' output is). They don't have to be sorted though:
+    stacks of an already frozen bucket go to a new mutable tree. It's merged into the frozen
+    one once it has as many samples (or on widening and freeze()), so the samples of a bucket
+    are merged a few times at most however the stacks are ordered.
+    """
+    def __init__(self, max_buckets=MAX_BUCKETS, bucket_width=INITIAL_BUCKET_WIDTH):
+        """__init__(self, max_buckets: int, bucket_width: float)
+        """
+        self._max_buckets = max_buckets
+        self._bucket_width = bucket_width
+        self._origin = None
+        # Bucket index -> FrozenCallFrameTree. Bucket i starts at _origin + i * _bucket_width.
+        self._buckets = {}
+        # Bucket index -> CallFrameTree of the buckets stacks are being added to. The ones
+        # that are also in _buckets got stacks after they were frozen.
+        self._open = {}
+        self._first = self._last = 0
+        # Stacks without a timestamp. They're only a part of the full tree.
+        self._untimed = CallFrameTree()
+
+    def add_stack(self, timestamp, frames, count):
+        """add_stack(self, timestamp: float, frames: list[str], count: int)
+        'timestamp' is in seconds. If it's None, the stack is not in any bucket.
+        """
+        if timestamp is None:
+            self._untimed.add_stack(frames, count)
+            return
+        if self._origin is None:
+            self._origin = timestamp
+        index = int((timestamp - self._origin) // self._bucket_width)
+        call_tree = self._open.get(index)
+        if call_tree is None:
+            if not self._open or index > max(self._open):
+                # Time moved on, so the open buckets are finished
+                self._close()
+            while max(self._last, index) - min(self._first, index) >= self._max_buckets:
+                self._widen()
+                index = int((timestamp - self._origin) // self._bucket_width)
+            self._first = min(self._first, index)
+            self._last = max(self._last, index)
+            call_tree = self._open.get(index)
+            if call_tree is None:
+                call_tree = self._open[index] = CallFrameTree()
+        call_tree.add_stack(frames, count)
+
+    def add_stacks(self, stacks):
+        """add_stacks(self, stacks: iterable[(float, list[str], int)])
+        """
+        for timestamp, frames, count in stacks:
+            self.add_stack(timestamp, frames, count)
+
+    def _close(self, reopened=False):
+        """Freeze open buckets. Buckets that were frozen before stay open until they have
+        as many samples as their frozen trees, unless 'reopened' is True.
+        """
+        still_open = {}
+        for index, call_tree in self._open.items():
+            frozen_tree = self._buckets.get(index)
+            if frozen_tree is None:
+                self._buckets[index] = call_tree.freeze()
+            elif reopened or call_tree.head.count >= frozen_tree.head.count:
+                self._buckets[index] = merge_frozen_trees([frozen_tree, call_tree.freeze()])
+            else:
+                still_open[index] = call_tree
+        self._open = still_open
+
+    def _widen(self):
+        """Double the bucket width and merge every two neighbouring buckets.
+        """
+        self._close(reopened=True)
+        self._bucket_width *= 2
+        pairs = {}
+        # Floor division keeps bucket boundaries aligned for negative indexes too
+        for index, frozen_tree in sorted(self._buckets.items()):
+            pairs.setdefault(index // 2, []).append(frozen_tree)
+        self._buckets = dict((index, merge_frozen_trees(trees)) for index, trees in pairs.items())
+        self._first //= 2
+        self._last //= 2
+
+    def freeze(self):
+        """freeze(self) -> SampleTimeline
+        """
+        self._close(reopened=True)
+        buckets = [self._buckets.get(index) for index in range(self._first, self._last + 1)]
+        if self._origin is None:
+            buckets = []
+            start = 0
+        else:
+            start = self._origin + self._first * self._bucket_width
+        untimed = self._untimed.freeze() if self._untimed.head.count else None
+        return SampleTimeline(buckets, start, self._bucket_width, untimed)
+
+
+class SampleTimeline(object):
+    """Frozen call trees of consecutive time buckets.
+
+    start - start time of the first bucket in seconds.
+    bucket_width - width of every bucket in seconds.
+    counts - number of samples in every bucket.
+    """
+    def __init__(self, buckets, start, bucket_width, untimed=None):
+        """__init__(self, buckets: list[FrozenCallFrameTree], start: float, bucket_width: float,
+                    untimed: FrozenCallFrameTree)
+        'buckets' could have None for buckets without samples. 'untimed' are stacks without
+        a timestamp (if any).
+        """
+        self._buckets = buckets
+        self._untimed = untimed
+        self.start = start
+        self.bucket_width = bucket_width
+        self.counts = [0 if call_tree is None else call_tree.head.count for call_tree in buckets]
+
+    def __len__(self):
+        """Number of buckets.
+        """
+        return len(self._buckets)
+
+    def bucket_start(self, index):
+        """bucket_start(self, index: int) -> float
+        Return the start time of the bucket in seconds.
+        """
+        return self.start + index * self.bucket_width
+
+    def tree(self, first, last):
+        """tree(self, first: int, last: int) -> FrozenCallFrameTree
+        Return the call tree of the samples in buckets [first, last].
+        """
+        trees = [call_tree for call_tree in self._buckets[first:last + 1] if call_tree is not None]
+        if not trees:
+            return CallFrameTree().freeze()
+        return merge_trees(trees)
+
+    def full_tree(self):
+        """full_tree(self) -> FrozenCallFrameTree
+        Return the call tree of all samples, including the ones without a timestamp.
+        """
+        trees = [call_tree for call_tree in self._buckets if call_tree is not None]
+        if self._untimed is not None:
+            trees.append(self._untimed)
+        if not trees:
+            return CallFrameTree().freeze()
+        return merge_trees(trees)
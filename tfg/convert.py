@@ -0,0 +1,277 @@
+"""Batch conversion of stack files to the collapsed format.
+Does the same as 'tfg.py -d' for many files at once, without the terminal browser:
+
+    convert.py -t perf -d out/ a.stacks b.stacks.gz ...   - a collapsed file per input file.
+    convert.py -t perf -o all.folded a.stacks b.stacks ...   - all input files merged in one.
+
+Input files are parsed by a process pool, a file per process. Output is written in big
+blocks, is optionally compressed and stacks are always sorted by frame names, so the same
+input produces the same output byte for byte.
+"""
+
+import argparse
+import bz2
+import gzip
+import io
+import os
+import sys
+from multiprocessing import Pool
+from tfg.calltree.calltree import CallFrameTree
+from tfg.ingest.reader import STDIN, open_input
+from tfg.stackcollapsers.collapsers import COLLAPSERS
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+
+PY2 = sys.version_info[0] == 2
+SUFFIX = '.folded'
+COMPRESSION_SUFFIXES = {
+    'gzip': '.gz',
+    'bzip2': '.bz2',
+    'xz': '.xz',
+}
+
+
+class ConvertException(Exception):
+    pass
+
+
+def compression_from_name(path):
+    """compression_from_name(path: str) -> str
+    Return compression name based on the file name suffix or None if there is none.
+    """
+    for compression, suffix in COMPRESSION_SUFFIXES.items():
+        if path.endswith(suffix):
+            return compression
+    return None
+
+
+class _CompressedFile(object):
+    """Write-only file that compresses data with 'compressor' before writing it to 'fileobj'.
+    Used for bzip2 on Python 2, where BZ2File only takes a file name.
+    """
+    def __init__(self, fileobj, compressor):
+        self._fileobj = fileobj
+        self._compressor = compressor
+
+    def write(self, data):
+        self._fileobj.write(self._compressor.compress(data))
+
+    def close(self):
+        if self._compressor is not None:
+            self._fileobj.write(self._compressor.flush())
+            self._compressor = None
+        self._fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_output(path, compression=None):
+    """open_output(path: str, compression: str) -> file
+    Open the output file for collapsed stacks, compressing it with 'compression' if it's
+    given. '-' is stdout.
+    On Python 3 it's a text file. On Python 2 frame names are byte strings, so it's a binary
+    file and they are written as they were read.
+    """
+    if path == STDIN:
+        if compression is None and not PY2:
+            return io.open(sys.stdout.fileno(), 'w', encoding='utf-8', closefd=False)
+        raw = io.open(sys.stdout.fileno(), 'wb', closefd=False)
+    else:
+        raw = io.open(path, 'wb')
+    if compression == 'gzip':
+        # Don't store the file name and time, so the output only depends on the input
+        raw = gzip.GzipFile(filename='', mode='wb', fileobj=raw, mtime=0)
+    elif compression == 'bzip2':
+        if PY2:
+            raw = _CompressedFile(raw, bz2.BZ2Compressor())
+        else:
+            raw = bz2.BZ2File(raw, 'wb')
+    elif compression == 'xz':
+        if lzma is None:
+            raise ConvertException('xz compression is not supported by this Python version')
+        raw = lzma.LZMAFile(raw, 'wb')
+    if PY2:
+        return raw
+    return io.TextIOWrapper(raw, encoding='utf-8')
+
+
+def output_path(output_dir, input_path, compression):
+    """output_path(output_dir: str, input_path: str, compression: str) -> str
+    Return the output file for 'input_path': its name without the compression suffix
+    plus SUFFIX and the new compression suffix.
+    """
+    name = os.path.basename(input_path)
+    input_compression = compression_from_name(name)
+    if input_compression is not None:
+        name = name[:-len(COMPRESSION_SUFFIXES[input_compression])]
+    if compression is not None:
+        return os.path.join(output_dir, name + SUFFIX + COMPRESSION_SUFFIXES[compression])
+    return os.path.join(output_dir, name + SUFFIX)
+
+
+def parse_file(path, file_type):
+    """parse_file(path: str, file_type: str) -> CallFrameTree
+    """
+    call_tree = CallFrameTree()
+    with open_input(path) as input_file:
+        call_tree.add_stacks(COLLAPSERS[file_type](input_file).parse())
+    return call_tree
+
+
+def _convert_file(args):
+    """Convert a single file in a worker process. Return an error message or None.
+    """
+    input_path, file_type, output_file, compression = args
+    # Don't leave a partial output file if parsing or writing fails
+    temp_path = output_file + '.tmp'
+    try:
+        call_tree = parse_file(input_path, file_type)
+        with open_output(temp_path, compression) as output:
+            call_tree.dump(output)
+        os.rename(temp_path, output_file)
+    except Exception as ex:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return '{}: {}'.format(input_path, ex)
+    return None
+
+
+def _parse_file(args):
+    """Parse a single file in a worker process. Return (frozen tree, None) or (None, error
+    message). Frozen trees are much cheaper to send back to the main process.
+    """
+    input_path, file_type = args
+    try:
+        return parse_file(input_path, file_type).freeze(), None
+    except Exception as ex:
+        return None, '{}: {}'.format(input_path, ex)
+
+
+def convert_files(inputs, file_type, output_dir, compression=None, jobs=1):
+    """convert_files(inputs: list[str], file_type: str, output_dir: str, compression: str,
+                     jobs: int) -> list[str]
+    Convert every input file into its own collapsed file in 'output_dir'. Return error
+    messages of the files that failed to convert. Other files are converted anyway.
+    """
+    tasks = [(path, file_type, output_path(output_dir, path, compression), compression)
+             for path in inputs]
+    if jobs == 1 or len(tasks) == 1:
+        results = [_convert_file(task) for task in tasks]
+    else:
+        pool = Pool(min(jobs, len(tasks)))
+        try:
+            results = pool.map(_convert_file, tasks, chunksize=1)
+        finally:
+            pool.terminate()
+            pool.join()
+    return [error for error in results if error is not None]
+
+
+def merge_files(inputs, file_type, output, compression=None, jobs=1):
+    """merge_files(inputs: list[str], file_type: str, output: str, compression: str,
+                   jobs: int) -> list[str]
+    Merge stacks of all input files in a single collapsed file 'output'. Return error
+    messages of the files that failed to parse. The output is written only if all files
+    were parsed.
+    """
+    call_tree = CallFrameTree()
+    errors = []
+    tasks = [(path, file_type) for path in inputs]
+    if jobs == 1 or len(tasks) == 1:
+        results = (_parse_file(task) for task in tasks)
+        pool = None
+    else:
+        pool = Pool(min(jobs, len(tasks)))
+        results = pool.imap_unordered(_parse_file, tasks)
+    try:
+        for partial_tree, error in results:
+            if error is not None:
+                errors.append(error)
+            else:
+                call_tree.merge(partial_tree)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    if not errors:
+        with open_output(output, compression) as output_file:
+            call_tree.dump(output_file)
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert stack files to the collapsed format')
+    parser.add_argument('-t',
+                        '--type',
+                        type=str,
+                        dest='file_type',
+                        default='none',
+                        choices=COLLAPSERS.keys(),
+                        help='Input file type')
+    parser.add_argument('-d',
+                        '--output-dir',
+                        type=str,
+                        dest='output_dir',
+                        default=None,
+                        help="""Write a collapsed file per input file to this directory.
+                                Output files are named after input files plus '{}'""".format(SUFFIX))
+    parser.add_argument('-o',
+                        '--output',
+                        type=str,
+                        dest='output',
+                        default=None,
+                        help="""Merge stacks of all input files in this file ('-' for stdout).
+                                Compressed if the name ends with .gz, .bz2 or .xz""")
+    parser.add_argument('-z',
+                        '--compress',
+                        type=str,
+                        dest='compression',
+                        default=None,
+                        choices=sorted(COMPRESSION_SUFFIXES),
+                        help='Compress output files')
+    parser.add_argument('-j',
+                        '--jobs',
+                        type=int,
+                        dest='jobs',
+                        default=1,
+                        help='Number of processes used to parse input files')
+    parser.add_argument('files',
+                        nargs='+',
+                        help='Input files. Compressed (gzip, xz, bzip2) files are supported')
+
+    args = parser.parse_args()
+    if (args.output_dir is None) == (args.output is None):
+        parser.error('exactly one of --output-dir and --output is required')
+    if args.jobs < 1:
+        parser.error('--jobs should be at least 1')
+    if STDIN in args.files:
+        parser.error('stdin can\'t be converted in batch mode, use tfg.py -d')
+
+    if args.output_dir is not None:
+        # Output files are named after input file names only, so files with the same name
+        # in different directories would overwrite each other
+        inputs = {}
+        for path in args.files:
+            inputs.setdefault(output_path(args.output_dir, path, args.compression), []).append(path)
+        for output_file, paths in sorted(inputs.items()):
+            if len(paths) > 1:
+                parser.error('{} would all be written to {}, convert them to different '
+                             'directories'.format(', '.join(paths), output_file))
+        if not os.path.isdir(args.output_dir):
+            os.makedirs(args.output_dir)
+        errors = convert_files(args.files, args.file_type, args.output_dir, args.compression,
+                               args.jobs)
+    else:
+        compression = args.compression or compression_from_name(args.output)
+        errors = merge_files(args.files, args.file_type, args.output, compression, args.jobs)
+    for error in errors:
+        sys.stderr.write('{}\n'.format(error))
+    if errors:
+        sys.exit(1)
@@ -0,0 +1,212 @@
+"""SVG and HTML export of a flame graph.
+The layout follows flamegraph.pl from https://github.com/brendangregg/FlameGraph: the
+head frame is at the bottom, children are sorted by name and a frame is as wide as its
+share of all samples.
+
+Frames are written to the output file as the tree is walked, so the document is never
+held in memory. Like VisualFrameTree combines frames that are too narrow to draw into a
+single '+' frame, children narrower than 'min_width' pixels are combined into one '+'
+frame and their subtrees are skipped, so the output size is bounded by the image width
+rather than by the size of the tree.
+"""
+
+import zlib
+from xml.sax.saxutils import escape
+from tfg.calltree.diff import DiffCallFrameTree
+
+
+FRAME_HEIGHT = 16
+FONT_SIZE = 12
+# Average character width relative to the font size. Used to fit names into frames.
+FONT_WIDTH = 0.59
+PADDING = 10
+TITLE_HEIGHT = FONT_SIZE * 3
+# Flush the output every that many bytes
+BUFFER_SIZE = 1 << 16
+
+SVG_HEADER = """<?xml version="1.0" encoding="utf-8" standalone="no"?>
+<!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1.1//EN" "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">
+"""
+HTML_HEADER = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{ margin: 0; background: #eeeeee; }}
+svg g:hover rect {{ stroke: #000000; stroke-width: 0.5; }}
+</style>
+</head>
+<body>
+"""
+HTML_FOOTER = """</body>
+</html>
+"""
+
+
+def _hot_color(name):
+    """Return a color from the 'hot' palette. The same name always gets the same color.
+    """
+    value = zlib.crc32(name.encode('utf-8')) & 0xffffffff
+    return 'rgb({},{},{})'.format(205 + (value & 0xff) * 50 // 255,
+                                  (value >> 8 & 0xff) * 230 // 255,
+                                  (value >> 16 & 0xff) * 55 // 255)
+
+
+def _delta_color(ratio):
+    """Return red for frames that gained samples and blue for frames that lost them.
+    See Palette.delta().
+    """
+    fade = 255 - int(min(abs(ratio), 1.0) * 255)
+    if ratio > 0:
+        return 'rgb(255,{0},{0})'.format(fade)
+    return 'rgb({0},{0},255)'.format(fade)
+
+
+def _fit_name(name, width):
+    """Return as much of 'name' as fits 'width' pixels or '' if nothing useful does.
+    """
+    chars = int(width / (FONT_SIZE * FONT_WIDTH))
+    if chars < 3:
+        return ''
+    if len(name) <= chars:
+        return name
+    return name[:chars - 2] + '..'
+
+
+class _BufferedWriter(object):
+    """Collect small strings and write them to a binary file in big utf-8 encoded blocks.
+    """
+    def __init__(self, output_file):
+        self._output_file = output_file
+        self._parts = []
+        self._size = 0
+
+    def write(self, text):
+        self._parts.append(text)
+        self._size += len(text)
+        if self._size >= BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        self._output_file.write(''.join(self._parts).encode('utf-8'))
+        self._parts = []
+        self._size = 0
+
+
+class FlameGraphExporter(object):
+    """Write a call tree as a flame graph.
+
+    width - image width in pixels.
+    min_width - frames narrower than that (in pixels) are combined into '+' frames.
+    title - title of the image.
+    """
+    def __init__(self, call_tree, width=1200, min_width=0.1, title='Flame Graph'):
+        """__init__(self, call_tree: CallFrameTree, width: int, min_width: float, title: str)
+        'call_tree' could be any kind of call tree. DiffCallFrameTree is exported as a
+        differential flame graph.
+        """
+        self._call_tree = call_tree
+        self._diff = call_tree if isinstance(call_tree, DiffCallFrameTree) else None
+        self._width = width
+        self._min_width = min_width
+        self._title = title
+        self._total = call_tree.head.count
+        # Pixels per sample
+        self._scale = float(width - 2 * PADDING) / self._total if self._total else 0.0
+
+    def export(self, path):
+        """export(self, path: str)
+        Write the flame graph to 'path'. Files ending with '.html' or '.htm' are written as
+        a self-contained HTML page, everything else as SVG.
+        """
+        html = path.lower().endswith(('.html', '.htm'))
+        with open(path, 'wb') as output_file:
+            writer = _BufferedWriter(output_file)
+            if html:
+                writer.write(HTML_HEADER.format(title=escape(self._title)))
+            else:
+                writer.write(SVG_HEADER)
+            self.write_svg(writer)
+            if html:
+                writer.write(HTML_FOOTER)
+            writer.flush()
+
+    def write_svg(self, writer):
+        """write_svg(self, writer: file)
+        Write the <svg> element with all frames to 'writer' (anything with write(str)).
+        """
+        # The image height depends on the number of levels, which has to be known before
+        # any frame is written. Counting them is much cheaper than writing the frames.
+        levels = self._levels()
+        height = TITLE_HEIGHT + levels * FRAME_HEIGHT + PADDING
+        writer.write('<svg version="1.1" width="{0}" height="{1}" viewBox="0 0 {0} {1}" '
+                     'xmlns="http://www.w3.org/2000/svg">\n'.format(self._width, height))
+        writer.write('<rect x="0" y="0" width="100%" height="100%" fill="#eeeeee"/>\n')
+        writer.write('<text x="{}" y="{}" font-size="{}" font-family="Verdana" '
+                     'text-anchor="middle">{}</text>\n'.format(
+                         self._width // 2, FONT_SIZE * 2, FONT_SIZE + 5, escape(self._title)))
+        writer.write('<g font-size="{}" font-family="Verdana">\n'.format(FONT_SIZE))
+        bottom = height - PADDING
+        for x, level, width, cf, combined in self._frames():
+            y = bottom - (level + 1) * FRAME_HEIGHT
+            if combined is not None:
+                self._write_frame(writer, x, y, width, '+', '{} frames'.format(combined[0]),
+                                  combined[1], '#bbbbbb')
+            else:
+                self._write_frame(writer, x, y, width, cf.name, cf.name, cf.count,
+                                  self._color(cf))
+        writer.write('</g>\n</svg>\n')
+
+    def _write_frame(self, writer, x, y, width, text, name, count, color):
+        writer.write('<g><title>{} ({} samples, {:.2f}%)</title>'
+                     '<rect x="{:.1f}" y="{}" width="{:.1f}" height="{}" fill="{}" rx="2" ry="2"/>'
+                     .format(escape(name), count, count * 100.0 / self._total if self._total else 0,
+                             x, y, width, FRAME_HEIGHT - 1, color))
+        label = _fit_name(text, width)
+        if label:
+            writer.write('<text x="{:.1f}" y="{}">{}</text>'.format(
+                x + 3, y + FRAME_HEIGHT - 4, escape(label)))
+        writer.write('</g>\n')
+
+    def _color(self, cf):
+        if self._diff is not None:
+            max_delta = self._diff.max_delta
+            return _delta_color(self._diff.delta(cf) / max_delta if max_delta else 0)
+        return _hot_color(cf.name)
+
+    def _levels(self):
+        """Return the number of levels with at least one frame.
+        """
+        levels = 0
+        for _, level, _, _, _ in self._frames():
+            levels = max(levels, level + 1)
+        return levels
+
+    def _frames(self):
+        """Yield (x, level, width, cf, combined) for every frame to draw in the depth-first
+        order. For '+' frames cf is None and 'combined' is (number of combined frames,
+        their sample count). For normal frames 'combined' is None.
+        """
+        head = self._call_tree.head
+        pending = [(float(PADDING), 0, head)]
+        while pending:
+            x, level, cf = pending.pop()
+            yield x, level, cf.count * self._scale, cf, None
+            combined_frames = 0
+            combined_count = 0
+            children = []
+            for child_cf in cf.sorted_frames:
+                child_width = child_cf.count * self._scale
+                if child_width < self._min_width or child_cf.count == 0:
+                    combined_frames += 1
+                    combined_count += child_cf.count
+                else:
+                    children.append((x, level + 1, child_cf))
+                    x += child_width
+            # Like in VisualFrameTree, the combined frame goes after all other children
+            combined_width = combined_count * self._scale
+            if combined_frames and combined_width >= self._min_width:
+                yield x, level + 1, combined_width, None, (combined_frames, combined_count)
+            # Children are pushed in reverse so they're written from left to right
+            pending.extend(reversed(children))
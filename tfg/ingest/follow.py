@@ -0,0 +1,27 @@
+"""Follow a growing input file (like 'tail -f').
+"""
+
+import time
+
+
+def follow_lines(input_file, interval=0.5, stop_event=None):
+    """follow_lines(input_file: file, interval: float, stop_event: threading.Event) -> iterator[str]
+    Yield complete lines from the input file. When the end of the file is reached, wait
+    'interval' seconds for new data to be appended instead of stopping.
+    Stop only when 'stop_event' is set.
+    """
+    partial_line = ''
+    while stop_event is None or not stop_event.is_set():
+        line = input_file.readline()
+        if not line:
+            if stop_event is not None:
+                stop_event.wait(interval)
+            else:
+                time.sleep(interval)
+            continue
+        # The writer may be in the middle of writing a line
+        if not line.endswith('\n'):
+            partial_line += line
+            continue
+        yield partial_line + line
+        partial_line = ''
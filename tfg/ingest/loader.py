@@ -0,0 +1,95 @@
+"""Background loading of stacks into a CallFrameTree.
+"""
+
+import os
+import threading
+import time
+
+
+class ParseProgress(object):
+    """How much of a plain input file a collapser has parsed. Has the same 'size' and
+    'position' as InputReader, which isn't used for plain files.
+    """
+    def __init__(self, path, collapser):
+        """__init__(self, path: str, collapser: StackCollapser)
+        """
+        self.size = os.path.getsize(path)
+        self._collapser = collapser
+
+    @property
+    def position(self):
+        return self._collapser.position
+
+
+class BackgroundLoader(threading.Thread):
+    """Thread that adds stacks to a CallFrameTree while the tree is being displayed.
+
+    lock - should be held by anyone reading the tree while the loader is running.
+    generation - incremented every time new stacks are added. Can be used to find
+        out whether the tree has changed since the last check.
+    samples - number of samples added so far.
+    reader - InputReader or ParseProgress of the input file or None. Its 'position' and
+        'size' tell how much of the input file has been read.
+    start_time, end_time - when loading started and stopped (None until then).
+    completed - True if all stacks were added (i.e. loading wasn't cancelled and didn't fail).
+    error - exception raised while parsing (if any).
+    """
+    def __init__(self, call_tree, stacks, pruner=None, reader=None, stop_event=None):
+        """__init__(self, call_tree: CallFrameTree, stacks: iterable[(list[str], int)],
+                    pruner: Pruner, reader: InputReader | ParseProgress,
+                    stop_event: threading.Event)
+        If 'pruner' is given, it's used to add stacks, so the tree stays small.
+        'stop_event' is set by cancel(). Pass the same event to whatever produces the stacks
+        if it could block for a long time (e.g. follow_lines()).
+        """
+        super(BackgroundLoader, self).__init__()
+        self.daemon = True
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.samples = 0
+        self.reader = reader
+        self.start_time = None
+        self.end_time = None
+        self.completed = False
+        self.error = None
+        self._call_tree = call_tree
+        self._stacks = stacks
+        self._pruner = pruner
+        self._stop_event = stop_event or threading.Event()
+
+    def cancel(self):
+        """Stop loading. Stacks added so far stay in the tree.
+        """
+        self._stop_event.set()
+
+    @property
+    def cancelled(self):
+        return self._stop_event.is_set() and not self.completed
+
+    def run(self):
+        self.start_time = time.time()
+        try:
+            # The lock is taken per stack rather than around the loop, since getting the
+            # next stack may block for a long time waiting for new input.
+            for frames, count in self._stacks:
+                if self._stop_event.is_set():
+                    break
+                with self.lock:
+                    if self._pruner is None:
+                        self._call_tree.add_stack(frames, count)
+                    else:
+                        self._pruner.add_stack(self._call_tree, frames, count)
+                    self.samples += count
+                    self.generation += 1
+            else:
+                if self._pruner is not None:
+                    with self.lock:
+                        self._pruner.compact(self._call_tree)
+                        self.generation += 1
+                self.completed = True
+        except Exception as ex:
+            # Reading fails once the input is closed after cancel(), that's not an error
+            if not self._stop_event.is_set():
+                self.error = ex
+        finally:
+            self.end_time = time.time()
@@ -0,0 +1,105 @@
+"""Parallel parsing of a single input file.
+The input file is split into chunks at sample boundaries, every chunk is parsed into
+its own CallFrameTree in a process pool and all partial trees are merged together.
+"""
+
+import locale
+import os
+from multiprocessing import Pool
+from tfg.calltree.calltree import CallFrameTree
+
+
+# Don't bother splitting the file into chunks smaller than that.
+MIN_CHUNK_SIZE = 1 << 20
+# Number of chunks per job. Using more chunks than jobs helps to balance the load
+# when some parts of the file are slower to parse than others.
+CHUNKS_PER_JOB = 4
+
+
+def split_file(path, chunks, on_blank_lines):
+    """split_file(path: str, chunks: int, on_blank_lines: bool) -> list[(int, int)]
+    Split file into at most 'chunks' [start, end) byte ranges of roughly the same size.
+    Every range starts at the beginning of a line. If 'on_blank_lines' is True, ranges
+    are split right after blank lines only, so a multiline sample is never split
+    between two ranges.
+    """
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as input_file:
+        for k in range(1, chunks):
+            offset = size * k // chunks
+            if offset <= bounds[-1]:
+                continue
+            input_file.seek(offset)
+            # Skip the rest of the (probably) partial line
+            input_file.readline()
+            if on_blank_lines:
+                line = input_file.readline()
+                while line.strip():
+                    line = input_file.readline()
+            position = input_file.tell()
+            if position >= size:
+                break
+            if position > bounds[-1]:
+                bounds.append(position)
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def read_lines(path, start, end, encoding=None):
+    """read_lines(path: str, start: int, end: int, encoding: str) -> iterator[str]
+    Yield decoded lines from the [start, end) byte range of the file.
+    'start' should point to the beginning of a line.
+    """
+    encoding = encoding or locale.getpreferredencoding(False)
+    with open(path, 'rb') as input_file:
+        input_file.seek(start)
+        position = start
+        while position < end:
+            line = input_file.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line.decode(encoding)
+
+
+def _parse_chunk(args):
+    """Parse a single chunk in a worker process.
+    Return a frozen tree since it's much cheaper to send back to the main process.
+    """
+    path, start, end, collapser_cls, pruner, collapser_kwargs = args
+    call_tree = CallFrameTree()
+    add_stacks = call_tree.add_stacks if pruner is None else \
+        lambda stacks: pruner.add_stacks(call_tree, stacks)
+    add_stacks(collapser_cls(read_lines(path, start, end), **collapser_kwargs).parse())
+    return call_tree.freeze()
+
+
+def parse_parallel(path, collapser_cls, jobs, pruner=None, collapser_kwargs=None):
+    """parse_parallel(path: str, collapser_cls: type, jobs: int, pruner: Pruner,
+                      collapser_kwargs: dict) -> CallFrameTree
+    Parse the file with 'jobs' worker processes and return the merged CallFrameTree.
+    The result is the same as parsing the whole file with collapser_cls in one go.
+    If 'pruner' is given, workers only fold frames deeper than its max depth and the merged
+    tree is compacted once, so small frames are pruned by their total count.
+    'collapser_kwargs' are passed to collapser_cls (e.g. the normalizer and the sample filter).
+    Every worker gets its own copy of them, so every worker starts with an empty symbol cache.
+    """
+    chunks = max(1, min(jobs * CHUNKS_PER_JOB, os.path.getsize(path) // MIN_CHUNK_SIZE))
+    ranges = split_file(path, chunks, collapser_cls.SPLIT_ON_BLANK_LINES)
+    call_tree = CallFrameTree()
+    if not ranges:
+        return call_tree
+    chunk_pruner = None if pruner is None else pruner.depth_pruner()
+    pool = Pool(min(jobs, len(ranges)))
+    try:
+        chunks_args = [(path, start, end, collapser_cls, chunk_pruner, collapser_kwargs or {})
+                       for start, end in ranges]
+        for partial_tree in pool.imap_unordered(_parse_chunk, chunks_args):
+            call_tree.merge(partial_tree)
+    finally:
+        pool.terminate()
+        pool.join()
+    if pruner is not None:
+        pruner.compact(call_tree)
+    return call_tree
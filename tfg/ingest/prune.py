@@ -0,0 +1,69 @@
+"""Pruning of small and deep frames while stacks are added to a CallFrameTree.
+"""
+
+from tfg.calltree.calltree import PRUNED
+
+
+# Number of added stacks between two compactions of a tree of a followed file.
+COMPACT_INTERVAL = 1 << 16
+
+
+class Pruner(object):
+    """Keep a CallFrameTree small while stacks are added to it.
+
+    Frames deeper than 'max_depth' are replaced with a single PRUNED frame as soon as a
+    stack is added. Frames with less than 'min_percent' of all samples are removed by
+    compacting the tree once all stacks are added (see CallFrameTree.prune()), so the result
+    doesn't depend on the order of stacks.
+
+    If 'compact_interval' is given, the tree is also compacted every 'compact_interval'
+    added stacks, so the number of nodes stays bounded however long the input is (e.g. a
+    followed file). A frame that was removed while it was small starts from zero when it
+    shows up again, so then the result depends on the order of stacks. Samples of removed
+    frames go to the PRUNED frames either way, so the total sample count is exact.
+    """
+    def __init__(self, min_percent=0, max_depth=None, compact_interval=None):
+        """__init__(self, min_percent: float, max_depth: int, compact_interval: int)
+        """
+        self._min_percent = min_percent
+        self._max_depth = max_depth
+        self._compact_interval = compact_interval
+        self._added = 0
+
+    def depth_pruner(self):
+        """depth_pruner(self) -> Pruner
+        Return a Pruner that only applies 'max_depth' or None if it's not set. Parts of the
+        input can be added with it and then merged and compacted with this Pruner, which
+        gives the same tree as adding the whole input with this Pruner.
+        """
+        if self._max_depth is None:
+            return None
+        return Pruner(0, self._max_depth)
+
+    def add_stack(self, call_tree, frames, count):
+        """add_stack(self, call_tree: CallFrameTree, frames: list[str], count: int)
+        Add a stack to the tree and compact the tree if it's time to.
+        """
+        if self._max_depth is not None and len(frames) > self._max_depth:
+            frames = list(frames[:self._max_depth])
+            frames.append(PRUNED)
+        call_tree.add_stack(frames, count)
+        if self._compact_interval is not None:
+            self._added += 1
+            if self._added % self._compact_interval == 0:
+                self.compact(call_tree)
+
+    def add_stacks(self, call_tree, stacks):
+        """add_stacks(self, call_tree: CallFrameTree, stacks: iterable[(list[str], int)])
+        Add all stacks to the tree and compact it at the end.
+        """
+        for frames, count in stacks:
+            self.add_stack(call_tree, frames, count)
+        self.compact(call_tree)
+
+    def compact(self, call_tree):
+        """compact(self, call_tree: CallFrameTree)
+        Prune the tree using the current total sample count.
+        """
+        min_count = call_tree.head.count * self._min_percent / 100.0
+        call_tree.prune(min_count, self._max_depth)
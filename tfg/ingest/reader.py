@@ -0,0 +1,261 @@
+"""Input file reader.
+Supports reading from stdin ('-') and transparent decompression of gzip, xz and bzip2
+files. Compression is detected by magic bytes rather than by the file name.
+
+Reading and decompression are done in a separate thread, which passes raw blocks to
+the parser through a bounded queue, so the parser doesn't wait for decompression
+(and vice versa) most of the time.
+"""
+
+import bz2
+import gzip
+import locale
+import os
+import sys
+import threading
+import zlib
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+
+STDIN = '-'
+BLOCK_SIZE = 1 << 20
+# Number of blocks the reader thread can get ahead of the parser
+QUEUE_SIZE = 16
+
+_MAGICS = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'BZh', 'bzip2'),
+)
+_MAGIC_SIZE = max(len(magic) for magic, _ in _MAGICS)
+
+
+class InputReaderException(Exception):
+    pass
+
+
+def detect_compression(header):
+    """detect_compression(header: bytes) -> str
+    Return compression name ('gzip', 'xz', 'bzip2') based on the first bytes of the
+    file or None if the file is not compressed.
+    """
+    for magic, compression in _MAGICS:
+        if header.startswith(magic):
+            return compression
+    return None
+
+
+def is_plain_file(path):
+    """is_plain_file(path: str) -> bool
+    Return True if 'path' is a regular (not stdin) uncompressed file. Those could be opened
+    with open() and support seeking and memory mapping.
+    """
+    if path == STDIN:
+        return False
+    with open(path, 'rb') as input_file:
+        return detect_compression(input_file.read(_MAGIC_SIZE)) is None
+
+
+def open_input(path):
+    """open_input(path: str) -> file | InputReader
+    Open the input file for reading lines. Plain files are opened as is, stdin and
+    compressed files are read with InputReader.
+    """
+    if is_plain_file(path):
+        return open(path, 'r')
+    return InputReader(path)
+
+
+class _PrefixedFile(object):
+    """Read-only file that returns 'prefix' before reading from 'fileobj'.
+    Used to put back bytes read from a stream that doesn't support seeking.
+    'prefix' should be the bytes read from the beginning of 'fileobj'.
+    """
+    def __init__(self, prefix, fileobj):
+        self._prefix = prefix
+        self._fileobj = fileobj
+
+    def tell(self):
+        return self._fileobj.tell() - len(self._prefix)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        # The prefix is a copy of the beginning of the file, so after seeking the file
+        # itself it's not needed anymore. Raises IOError if 'fileobj' is not seekable.
+        if whence == os.SEEK_CUR:
+            offset -= len(self._prefix)
+        self._fileobj.seek(offset, whence)
+        self._prefix = b''
+
+    def seekable(self):
+        try:
+            self._fileobj.tell()
+        except (IOError, OSError):
+            return False
+        return True
+
+    def close(self):
+        pass
+
+    def read(self, size=-1):
+        if not self._prefix:
+            return self._fileobj.read(size)
+        if size is None or size < 0:
+            data = self._prefix + self._fileobj.read()
+            self._prefix = b''
+            return data
+        data = self._prefix[:size]
+        self._prefix = self._prefix[size:]
+        return data
+
+
+class _DecompressedStream(object):
+    """Read-only stream of data of 'fileobj' decompressed with decompressors made by
+    'new_decompressor'. Concatenated compressed streams (e.g. of 'cat a.gz b.gz') are
+    decompressed one after another.
+    Used on Python 2, where GzipFile needs a seekable file and BZ2File only takes a name.
+    """
+    def __init__(self, fileobj, new_decompressor):
+        self._fileobj = fileobj
+        self._new_decompressor = new_decompressor
+        self._decompressor = new_decompressor()
+
+    def read(self, size):
+        while True:
+            data = self._fileobj.read(size)
+            if not data:
+                return b''
+            block = self._decompress(data)
+            if block:
+                return block
+
+    def _decompress(self, data):
+        blocks = []
+        while data:
+            blocks.append(self._decompressor.decompress(data))
+            data = self._decompressor.unused_data
+            if data:
+                # The next stream starts right after the end of the current one
+                self._decompressor = self._new_decompressor()
+        return b''.join(blocks)
+
+
+class InputReader(object):
+    """Iterable over lines of stdin or of a (possibly compressed) file.
+    Lines are decoded with 'encoding' (the locale encoding by default) and keep their
+    trailing '\\n' just like lines of a file opened in text mode.
+
+    size - size of the input file in bytes or None for stdin.
+    position - number of bytes of the input file read up to the last yielded line (compressed
+        bytes for compressed files). Accurate to a block.
+    """
+    def __init__(self, path, encoding=None):
+        """__init__(self, path: str, encoding: str)
+        """
+        self._encoding = encoding or locale.getpreferredencoding(False)
+        if path == STDIN:
+            # Use a duplicate of the stdin descriptor, so the terminal browser could
+            # replace stdin with the terminal while we're still reading from it.
+            self._file = os.fdopen(os.dup(sys.stdin.fileno()), 'rb')
+            self.size = None
+        else:
+            self._file = open(path, 'rb')
+            self.size = os.fstat(self._file.fileno()).st_size
+        self.position = 0
+        self._stream = self._open_stream(self._file)
+        self._queue = queue.Queue(QUEUE_SIZE)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._read_blocks)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __iter__(self):
+        remainder = b''
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            block, self.position = item
+            block = remainder + block
+            end = block.rfind(b'\n') + 1
+            remainder = block[end:]
+            if end:
+                lines = block[:end].decode(self._encoding).split('\n')
+                # The last item is always an empty string after the last '\n'
+                for i in range(len(lines) - 1):
+                    yield lines[i] + '\n'
+        if remainder:
+            yield remainder.decode(self._encoding)
+
+    def close(self):
+        """Stop the reader thread and close the input file.
+        The thread is not joined since it may be blocked reading from a pipe.
+        """
+        self._stop.set()
+        # Unblock the reader thread if it waits for free space in the queue
+        try:
+            while True:
+                self._queue.get_nowait()
+        except queue.Empty:
+            pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _open_stream(self, fileobj):
+        """Return a stream of decompressed data of 'fileobj'.
+        """
+        header = b''
+        while len(header) < _MAGIC_SIZE:
+            data = fileobj.read(_MAGIC_SIZE - len(header))
+            if not data:
+                break
+            header += data
+        fileobj = _PrefixedFile(header, fileobj)
+        compression = detect_compression(header)
+        if compression == 'gzip':
+            if sys.version_info[0] == 2 and not fileobj.seekable():
+                return _DecompressedStream(fileobj, lambda: zlib.decompressobj(16 + zlib.MAX_WBITS))
+            return gzip.GzipFile(fileobj=fileobj, mode='rb')
+        if compression == 'bzip2':
+            if sys.version_info[0] == 2:
+                return _DecompressedStream(fileobj, bz2.BZ2Decompressor)
+            return bz2.BZ2File(fileobj, 'rb')
+        if compression == 'xz':
+            if lzma is None:
+                raise InputReaderException('xz compressed input is not supported by this Python version')
+            return lzma.LZMAFile(fileobj, 'rb')
+        return fileobj
+
+    def _read_blocks(self):
+        """Reader thread. Put (decompressed block, position in the input file after it) to
+        the queue followed by None.
+        """
+        position = 0
+        try:
+            while not self._stop.is_set():
+                block = self._stream.read(BLOCK_SIZE)
+                if not block:
+                    break
+                # The position is only updated when the block is parsed
+                if self.size is not None:
+                    position = self._file.tell()
+                else:
+                    position += len(block)
+                self._queue.put((block, position))
+        except Exception as ex:
+            self._queue.put(ex)
+            return
+        self._queue.put(None)
@@ -7,36 +7,371 @@ Python 2 and 3 compatible.
 """
 
 import argparse
+import os
+import sys
+import threading
+from multiprocessing import Pool
 from tfg.calltree.calltree import CallFrameTree
-from tfg.stackcollapsers.stackcollapser import StackCollapser
-from tfg.stackcollapsers.dtracecollapser import DtraceCollapser
-from tfg.stackcollapsers.perfcollapser import PerfCollapser
-from tfg.stackcollapsers.pyspycollapser import PySpyCollapser
+from tfg.calltree.cache import CallTreeCache, DEFAULT_MAX_SIZE
+from tfg.calltree.diff import DiffCallFrameTree
+from tfg.calltree.sources import SourceCounts, merge_trees
+from tfg.calltree.timeline import TimelineBuilder
+from tfg.export.svg import FlameGraphExporter
+from tfg.ingest.follow import follow_lines
+from tfg.ingest.loader import BackgroundLoader, ParseProgress
+from tfg.ingest.parallel import parse_parallel
+from tfg.ingest.prune import COMPACT_INTERVAL, Pruner
+from tfg.ingest.reader import STDIN, is_plain_file, open_input
+from tfg.stackcollapsers.collapsers import COLLAPSERS
+from tfg.stackcollapsers.perfcollapser import PerfCollapser, SampleFilter
+from tfg.stackcollapsers.stackcollapser import DEFAULT_STAGES, NORMALIZATION_STAGES, \
+    SymbolNormalizer
 from tfg.browser.terminal import TerminalBrowser
 from tfg.browser.palette import PALETTES
+from tfg.stats import enable_stats, get_stats
 
 
-COLLAPSERS = {
-    'none': StackCollapser,
-    'dtrace': DtraceCollapser,
-    'perf': PerfCollapser,
-    'pyspy': PySpyCollapser,
-}
+def create_pruner(args, compact_interval=None):
+    """Return a Pruner for --min-percent and --max-depth or None if they are not used.
+    'compact_interval' is passed to the Pruner.
+    """
+    if args.min_percent or args.max_depth is not None:
+        return Pruner(args.min_percent, args.max_depth, compact_interval)
+    return None
 
 
-def process_args(args):
-    with open(args.file, 'r') as input_file:
+def create_normalizer(args, file_type):
+    """Return a SymbolNormalizer with the default stages of the 'file_type' collapser plus
+    the --normalize ones.
+    """
+    return SymbolNormalizer(COLLAPSERS[file_type].DEFAULT_STAGES + tuple(args.normalize))
+
+
+def create_sample_filter(args):
+    """Return a SampleFilter for --comm, --pid, --tid, --event and --time-range or None if
+    they are not used.
+    """
+    start, end = args.time_range or (None, None)
+    if args.comms is None and args.pids is None and args.tids is None and \
+            args.events is None and start is None and end is None:
+        return None
+    return SampleFilter(args.comms, args.pids, args.tids, args.events, start, end)
+
+
+def collapser_kwargs(args, file_type):
+    """Return keyword arguments of the collapser of 'file_type'. Only perf collapsers take
+    the sample filter.
+    """
+    kwargs = {'normalizer': create_normalizer(args, file_type)}
+    if is_perf_type(file_type):
+        sample_filter = create_sample_filter(args)
+        if sample_filter is not None:
+            kwargs['sample_filter'] = sample_filter
+    return kwargs
+
+
+def is_perf_type(file_type):
+    """Return True if 'file_type' is parsed by a perf collapser (so samples could be filtered).
+    """
+    return issubclass(COLLAPSERS[file_type], PerfCollapser)
+
+
+def cache_params(args, file_type):
+    """Return everything besides the input file that the parsed tree depends on.
+    """
+    sample_filter = create_sample_filter(args) if is_perf_type(file_type) else None
+    return (file_type, args.min_percent, args.max_depth, create_normalizer(args, file_type).stages,
+            None if sample_filter is None else sample_filter.params())
+
+
+def comma_list(value_type):
+    """Return an argparse type that parses comma separated values of 'value_type'.
+    """
+    def parse(value):
+        try:
+            return [value_type(item.strip()) for item in value.split(',') if item.strip()]
+        except ValueError:
+            raise argparse.ArgumentTypeError('invalid list: {}'.format(value))
+    return parse
+
+
+def time_range(value):
+    """Parse 'START,END' where either of them could be omitted into (start, end).
+    """
+    start, comma, end = value.partition(',')
+    try:
+        if not comma:
+            raise ValueError()
+        start = float(start) if start.strip() else None
+        end = float(end) if end.strip() else None
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected START,END in seconds: {}'.format(value))
+    if start is not None and end is not None and start > end:
+        raise argparse.ArgumentTypeError('START is after END: {}'.format(value))
+    return start, end
+
+
+def parse_input(spec, file_type):
+    """parse_input(spec: str, file_type: str) -> (str, str)
+    Return (file type, file name) for an input file given as 'file' or as 'type:file'.
+    'file_type' is used if the type is not given.
+    """
+    prefix, _, file_name = spec.partition(':')
+    if file_name and prefix in COLLAPSERS and not os.path.exists(spec):
+        return prefix, file_name
+    return file_type, spec
+
+
+def build_call_tree(args, file_type, file_name, jobs):
+    """Parse the input file into a CallFrameTree using 'jobs' processes.
+    """
+    collapser_cls = COLLAPSERS[file_type]
+    pruner = create_pruner(args)
+    kwargs = collapser_kwargs(args, file_type)
+    stats = get_stats()
+    if file_name != STDIN:
+        stats.add('input bytes', os.path.getsize(file_name))
+    # stdin and compressed files can't be split between processes
+    if jobs > 1 and is_plain_file(file_name):
+        # Stacks are parsed and added by the worker processes
+        with stats.phase('parse'):
+            return parse_parallel(file_name, collapser_cls, jobs, pruner, kwargs)
+    with open_input(file_name) as input_file:
         call_tree = CallFrameTree()
-        collapser = COLLAPSERS[args.file_type](input_file)
-        stacks = collapser.parse()
-        for stack in stacks:
-            call_tree.add_stack(stack[0], stack[1])
-        if args.dump:
-            call_tree.dump()
-            return
+        # Reading the input file is a part of parsing
+        collapser = collapser_cls(input_file, **kwargs)
+        stacks = stats.split(collapser.parse(), 'parse', 'add_stack', 'samples')
+        if pruner is None:
+            call_tree.add_stacks(stacks)
+        else:
+            pruner.add_stacks(call_tree, stacks)
+        return call_tree
+
+
+def _build_frozen_tree(task):
+    """Parse a single input file in a worker process.
+    Return a frozen tree since it's much cheaper to send back to the main process.
+    """
+    args, file_type, file_name = task
+    return build_call_tree(args, file_type, file_name, 1).freeze()
+
+
+def load_call_trees(args, inputs):
+    """load_call_trees(args, inputs: list[(str, str)]) -> list[FrozenCallFrameTree]
+    Return a frozen tree for every (file type, file name) input. Trees are loaded from the
+    cache if possible. If there are several files to parse, they're parsed by a process pool
+    (a file per process), otherwise the file is parsed with --jobs processes. Parsed trees
+    are put to the cache.
+    """
+    stats = get_stats()
+    cache = None
+    if not args.no_cache:
+        cache = CallTreeCache(args.cache_dir, args.cache_size << 20)
+    trees = [None] * len(inputs)
+    uncached = []
+    for i, (file_type, file_name) in enumerate(inputs):
+        if cache is not None and file_name != STDIN:
+            with stats.phase('cache load'):
+                trees[i] = cache.load(file_name, cache_params(args, file_type))
+        if trees[i] is None:
+            uncached.append(i)
+
+    # stdin can't be read by another process
+    pool_inputs = [i for i in uncached if inputs[i][1] != STDIN]
+    if args.jobs > 1 and len(pool_inputs) > 1:
+        pool = Pool(min(args.jobs, len(pool_inputs)))
+        try:
+            with stats.phase('parse'):
+                tasks = [(args,) + inputs[i] for i in pool_inputs]
+                for i, tree in zip(pool_inputs, pool.imap(_build_frozen_tree, tasks)):
+                    trees[i] = tree
+        finally:
+            pool.terminate()
+            pool.join()
+
+    for i in uncached:
+        file_type, file_name = inputs[i]
+        if trees[i] is None:
+            call_tree = build_call_tree(args, file_type, file_name, args.jobs)
+            with stats.phase('freeze'):
+                trees[i] = call_tree.freeze()
+            call_tree = None
+        if cache is not None and file_name != STDIN:
+            with stats.phase('cache store'):
+                cache.store(file_name, cache_params(args, file_type), trees[i])
+    return trees
+
+
+def add_tree_stats(call_tree):
+    """add_tree_stats(call_tree: FrozenCallFrameTree)
+    Report the size of the loaded tree to --stats.
+    """
+    stats = get_stats()
+    stats.add('nodes', len(call_tree))
+    stats.add('unique names', len(call_tree.names))
+
 
-        browser = TerminalBrowser(call_tree, args.ws_filler, PALETTES[args.palette])
+def load_call_tree(args, inputs):
+    """load_call_tree(args, inputs: list[(str, str)]) -> (FrozenCallFrameTree, SourceCounts)
+    Load trees of all (file type, file name) inputs and merge them in a single tree.
+    Return the tree and the per-input counts of its frames (None if there is only one input).
+    """
+    stats = get_stats()
+    trees = load_call_trees(args, inputs)
+    with stats.phase('merge'):
+        call_tree = merge_trees(trees)
+    sources = None
+    if len(trees) > 1:
+        sources = SourceCounts(call_tree, [file_name for _, file_name in inputs], trees)
+    add_tree_stats(call_tree)
+    return call_tree, sources
+
+
+def follow(args):
+    """Display the input file while new stacks are appended to it.
+    """
+    file_type, file_name = args.inputs[0]
+    plain_file = is_plain_file(file_name)
+    stop_event = threading.Event()
+    with open_input(file_name) as input_file:
+        # stdin and compressed files are just read as they come
+        lines = follow_lines(input_file, stop_event=stop_event) if plain_file else input_file
+        call_tree = CallFrameTree()
+        collapser = COLLAPSERS[file_type](lines, **collapser_kwargs(args, file_type))
+        stacks = get_stats().split(collapser.parse(), 'parse', 'add_stack', 'samples')
+        # The input never ends, so the tree is compacted periodically to bound its size
+        loader = BackgroundLoader(call_tree, stacks, create_pruner(args, COMPACT_INTERVAL),
+                                  None if plain_file else input_file, stop_event)
+        loader.start()
+        browser = TerminalBrowser(call_tree, args.ws_filler, PALETTES[args.palette],
+                                  loader, args.refresh_interval)
+        browser.display()
+        loader.cancel()
+        if loader.error is not None:
+            raise loader.error
+        if get_stats().enabled:
+            # The loader may still be waiting for new input
+            with loader.lock:
+                add_tree_stats(call_tree.freeze())
+
+
+def display_progressively(args):
+    """Display the input file right away and parse it in the background. The flame graph
+    is refreshed every --refresh-interval seconds while stacks are added. The parsed tree is
+    put to the cache if the whole file was loaded.
+    """
+    file_type, file_name = args.inputs[0]
+    stats = get_stats()
+    cache = None
+    if not args.no_cache and file_name != STDIN:
+        cache = CallTreeCache(args.cache_dir, args.cache_size << 20)
+        with stats.phase('cache load'):
+            call_tree = cache.load(file_name, cache_params(args, file_type))
+        if call_tree is not None:
+            add_tree_stats(call_tree)
+            TerminalBrowser(call_tree, args.ws_filler, PALETTES[args.palette]).display()
+            return
+    plain_file = is_plain_file(file_name)
+    if file_name != STDIN:
+        stats.add('input bytes', os.path.getsize(file_name))
+    # Plain files are read as is, without the reader thread of InputReader
+    with open_input(file_name) as input_file:
+        call_tree = CallFrameTree()
+        collapser = COLLAPSERS[file_type](input_file, **collapser_kwargs(args, file_type))
+        stacks = stats.split(collapser.parse(), 'parse', 'add_stack', 'samples')
+        progress = ParseProgress(file_name, collapser) if plain_file else input_file
+        loader = BackgroundLoader(call_tree, stacks, create_pruner(args), progress)
+        loader.start()
+        browser = TerminalBrowser(call_tree, args.ws_filler, PALETTES[args.palette],
+                                  loader, args.refresh_interval)
         browser.display()
+        # Quitting while the file is still loading cancels loading
+        loader.cancel()
+    # Let the loader stop before exiting, Python 2 tears down modules under running threads.
+    # It's not waited for long, since it may be blocked reading from a pipe.
+    loader.join(1)
+    if loader.error is not None:
+        raise loader.error
+    store = cache is not None and loader.completed
+    if not store and not stats.enabled:
+        return
+    # The loader may still be blocked reading from a pipe if loading was cancelled
+    with loader.lock, stats.phase('freeze'):
+        frozen_tree = call_tree.freeze()
+    add_tree_stats(frozen_tree)
+    if store:
+        with stats.phase('cache store'):
+            cache.store(file_name, cache_params(args, file_type), frozen_tree)
+
+
+def can_display_progressively(args):
+    """Return True if the flame graph could be displayed before the input file is parsed:
+    it's a single file that is displayed as it is and is parsed by a single process anyway.
+    """
+    file_name = args.inputs[0][1]
+    return len(args.inputs) == 1 and not args.wait and not args.dump and \
+        args.export is None and args.diff is None and not args.inverted and \
+        (args.jobs == 1 or not is_plain_file(file_name))
+
+
+def timeline(args):
+    """Display the input file with a timeline of its samples to choose a time window from.
+    """
+    file_type, file_name = args.inputs[0]
+    stats = get_stats()
+    if file_name != STDIN:
+        stats.add('input bytes', os.path.getsize(file_name))
+    builder = TimelineBuilder()
+    with open_input(file_name) as input_file:
+        collapser = COLLAPSERS[file_type](input_file, **collapser_kwargs(args, file_type))
+        builder.add_stacks(stats.split(collapser.parse_timed(), 'parse', 'add_stack', 'samples'))
+    with stats.phase('freeze'):
+        sample_timeline = builder.freeze()
+        call_tree = sample_timeline.full_tree()
+    stats.add('timeline buckets', len(sample_timeline))
+    add_tree_stats(call_tree)
+    # Samples without timestamps can't be put on the timeline
+    browser = TerminalBrowser(call_tree, args.ws_filler, PALETTES[args.palette],
+                              timeline=sample_timeline if len(sample_timeline) else None)
+    browser.display()
+
+
+def process_args(args):
+    if args.follow:
+        follow(args)
+        return
+    if args.timeline:
+        timeline(args)
+        return
+    if can_display_progressively(args):
+        display_progressively(args)
+        return
+
+    stats = get_stats()
+    call_tree, sources = load_call_tree(args, args.inputs)
+    if args.diff is not None:
+        old_call_tree, _ = load_call_tree(args, [parse_input(args.diff, args.file_type)])
+        with stats.phase('diff'):
+            call_tree = DiffCallFrameTree(old_call_tree, call_tree)
+    if args.inverted:
+        with stats.phase('invert'):
+            call_tree = call_tree.inverted()
+    if args.dump:
+        with stats.phase('dump'):
+            call_tree.dump()
+        return
+    if args.export is not None:
+        with stats.phase('export'):
+            title = os.path.basename(args.inputs[0][1])
+            if len(args.inputs) > 1:
+                title += ' and {} more'.format(len(args.inputs) - 1)
+            FlameGraphExporter(call_tree, args.export_width, args.min_width,
+                               title).export(args.export)
+        return
+
+    browser = TerminalBrowser(call_tree, args.ws_filler, PALETTES[args.palette],
+                              sources=sources)
+    browser.display()
 
 def main():
     parser = argparse.ArgumentParser(description='Command line flame graph browser')
@@ -65,6 +400,198 @@ def main():
                         default='hot',
                         choices=PALETTES.keys(),
                         help='Color palette')
-    parser.add_argument('file', help='Input file to parse')
+    parser.add_argument('-j',
+                        '--jobs',
+                        type=int,
+                        dest='jobs',
+                        default=1,
+                        help="""Number of processes used to parse the input file. With several
+                                input files, each file is parsed by its own process""")
+    parser.add_argument('--no-cache',
+                        dest='no_cache',
+                        action='store_true',
+                        help='Always parse the input file and don\'t store the result in the cache')
+    parser.add_argument('--cache-dir',
+                        type=str,
+                        dest='cache_dir',
+                        default=None,
+                        help='Directory to cache parsed files in (default: ~/.cache/tfg)')
+    parser.add_argument('--cache-size',
+                        type=int,
+                        dest='cache_size',
+                        default=DEFAULT_MAX_SIZE >> 20,
+                        help='Maximum size of the cache directory in MiB')
+    parser.add_argument('-f',
+                        '--follow',
+                        dest='follow',
+                        action='store_true',
+                        help='Keep reading stacks appended to the input file and refresh the flame graph')
+    parser.add_argument('--refresh-interval',
+                        type=float,
+                        dest='refresh_interval',
+                        default=1.0,
+                        help='Flame graph refresh interval in seconds while the input file is loaded')
+    parser.add_argument('--wait',
+                        dest='wait',
+                        action='store_true',
+                        help="""Parse the whole input file before displaying the flame graph.
+                                By default, a single input file is displayed right away and the
+                                flame graph is refreshed every --refresh-interval seconds while
+                                the file is parsed. Press 'x' to stop loading""")
+    parser.add_argument('--diff',
+                        type=str,
+                        dest='diff',
+                        default=None,
+                        metavar='OLD_FILE',
+                        help="""Display a differential flame graph of OLD_FILE and the input file
+                                (e.g. profiles of the previous and the new release). Frame widths
+                                are taken from the input file. Red frames have a bigger share of
+                                samples than in OLD_FILE, blue frames have a smaller one.
+                                With --dump, print 'frames old_count new_count' lines""")
+    parser.add_argument('--min-percent',
+                        type=float,
+                        dest='min_percent',
+                        default=0,
+                        help="""Fold frames with less than this percentage of all samples into
+                                a '[pruned]' frame of their parent. Saves memory and time for big
+                                profiles, since such frames are too small to be displayed anyway""")
+    parser.add_argument('--max-depth',
+                        type=int,
+                        dest='max_depth',
+                        default=None,
+                        help="""Fold frames deeper than this into a '[pruned]' frame of their
+                                parent""")
+    parser.add_argument('--normalize',
+                        type=str,
+                        dest='normalize',
+                        action='append',
+                        default=[],
+                        choices=[stage for stage in NORMALIZATION_STAGES
+                                 if stage not in DEFAULT_STAGES],
+                        help="""Normalize frame names before building the tree, so frames
+                                that differ only in details are merged: 'jit' folds bare
+                                addresses into '[jit]', 'python-lines' strips file and line
+                                numbers, 'cpp-args' and 'cpp-templates' strip C++ argument lists
+                                and template arguments. Can be given several times""")
+    parser.add_argument('--comm',
+                        type=comma_list(str),
+                        dest='comms',
+                        default=None,
+                        metavar='COMM[,COMM...]',
+                        help='perf only: keep samples of these commands only')
+    parser.add_argument('--pid',
+                        type=comma_list(int),
+                        dest='pids',
+                        default=None,
+                        metavar='PID[,PID...]',
+                        help='perf only: keep samples of these processes only')
+    parser.add_argument('--tid',
+                        type=comma_list(int),
+                        dest='tids',
+                        default=None,
+                        metavar='TID[,TID...]',
+                        help='perf only: keep samples of these threads only')
+    parser.add_argument('--event',
+                        type=comma_list(str),
+                        dest='events',
+                        default=None,
+                        metavar='EVENT[,EVENT...]',
+                        help="""perf only: keep samples of these events only. 'cycles' also
+                                matches 'cycles:u', etc.""")
+    parser.add_argument('--time-range',
+                        type=time_range,
+                        dest='time_range',
+                        default=None,
+                        metavar='START,END',
+                        help="""perf only: keep samples with timestamps (in seconds, as printed
+                                by perf script) in this range. START or END can be omitted""")
+    parser.add_argument('--timeline',
+                        dest='timeline',
+                        action='store_true',
+                        help="""perf only: index samples by their timestamps and display a
+                                timeline of samples over time above the status line. Press 'w' to
+                                display the flame graph of any time window without parsing the
+                                input file again""")
+    parser.add_argument('--export',
+                        type=str,
+                        dest='export',
+                        default=None,
+                        metavar='OUTPUT_FILE',
+                        help="""Write the flame graph to an SVG file and quit. If OUTPUT_FILE
+                                ends with .html, write a self-contained HTML page instead""")
+    parser.add_argument('--export-width',
+                        type=int,
+                        dest='export_width',
+                        default=1200,
+                        help='Width of the exported flame graph in pixels')
+    parser.add_argument('--min-width',
+                        type=float,
+                        dest='min_width',
+                        default=0.1,
+                        help="""Combine frames narrower than this (in pixels) into a single '+'
+                                frame in the exported flame graph""")
+    parser.add_argument('--stats',
+                        dest='stats',
+                        action='store_true',
+                        help="""Print time spent in every phase (parsing, building the tree,
+                                drawing, etc.), node counts and peak memory usage on exit""")
+    parser.add_argument('-i',
+                        '--inverted',
+                        dest='inverted',
+                        action='store_true',
+                        help="""Display an inverted (callee-rooted) flame graph: frames samples
+                                were taken in are at the bottom and their callers are above them.
+                                Use 'i' key to switch between the normal and the inverted view""")
+    parser.add_argument('files',
+                        nargs='+',
+                        metavar='file',
+                        help="""Input file to parse. Use - to read from stdin. gzip, xz and bzip2
+                                compressed files are decompressed on the fly. Stacks of several
+                                files (e.g. of the same workload on different hosts) are merged.
+                                Use TYPE:FILE to parse a file as another type than --type""")
 
-    process_args(parser.parse_args())
+    args = parser.parse_args()
+    args.inputs = [parse_input(spec, args.file_type) for spec in args.files]
+    if create_sample_filter(args) is not None:
+        file_types = [file_type for file_type, _ in args.inputs]
+        if args.diff is not None:
+            file_types.append(parse_input(args.diff, args.file_type)[0])
+        if not all(is_perf_type(file_type) for file_type in file_types):
+            parser.error('--comm, --pid, --tid, --event and --time-range can only be used '
+                         'with perf input files')
+    if args.follow and len(args.inputs) > 1:
+        parser.error('--follow can\'t be used with several input files')
+    if args.follow and args.dump:
+        parser.error('--follow can\'t be used with --dump')
+    if args.follow and args.export is not None:
+        parser.error('--follow can\'t be used with --export')
+    if args.export_width < 100:
+        parser.error('--export-width should be at least 100')
+    if args.min_width < 0:
+        parser.error('--min-width can\'t be negative')
+    if args.min_percent < 0 or args.min_percent > 100:
+        parser.error('--min-percent should be in [0, 100]')
+    if args.max_depth is not None and args.max_depth < 1:
+        parser.error('--max-depth should be at least 1')
+    if args.jobs < 1:
+        parser.error('--jobs should be at least 1')
+    if args.follow and args.inverted:
+        parser.error('--follow can\'t be used with --inverted')
+    if args.follow and args.diff is not None:
+        parser.error('--follow can\'t be used with --diff')
+    if args.timeline:
+        if len(args.inputs) > 1 or args.follow or args.diff is not None or args.dump or \
+                args.export is not None or args.inverted:
+            parser.error('--timeline can only be used to display a single input file')
+        if not hasattr(COLLAPSERS[args.inputs[0][0]], 'parse_timed'):
+            parser.error('--timeline can only be used with perf input files')
+        if args.min_percent or args.max_depth is not None:
+            parser.error('--timeline can\'t be used with --min-percent and --max-depth')
+    if [file_name for _, file_name in args.inputs].count(STDIN) + (args.diff == STDIN) > 1:
+        parser.error('only one of the files can be read from stdin')
+    if args.stats:
+        enable_stats()
+    try:
+        process_args(args)
+    finally:
+        get_stats().report(sys.stderr)
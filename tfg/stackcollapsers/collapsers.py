@@ -0,0 +1,16 @@
+"""All stack collapsers by the input file type (see the -t option).
+Kept separate from tfg.main, so tools that only parse stacks don't import the browser.
+"""
+
+from tfg.stackcollapsers.stackcollapser import StackCollapser
+from tfg.stackcollapsers.dtracecollapser import DtraceCollapser
+from tfg.stackcollapsers.perfcollapser import PerfCollapser
+from tfg.stackcollapsers.pyspycollapser import PySpyCollapser
+
+
+COLLAPSERS = {
+    'none': StackCollapser,
+    'dtrace': DtraceCollapser,
+    'perf': PerfCollapser,
+    'pyspy': PySpyCollapser,
+}
@@ -14,30 +14,36 @@ DTrace output example:
 Read more here: https://github.com/brendangregg/FlameGraph/blob/master/stackcollapse.pl
 """
 
-from tfg.stackcollapsers.stackcollapser import StackCollapser, StackCollapserException, trim_offset
+from tfg.stackcollapsers.stackcollapser import StackCollapser, StackCollapserException
+from tfg.stats import get_stats
 
 
 class DtraceCollapser(StackCollapser):
-    def __init__(self, input_file):
-        """__init__(self, input_file: file)
+    SPLIT_ON_BLANK_LINES = True
+
+    def __init__(self, input_file, normalizer=None):
+        """__init__(self, input_file: file, normalizer: SymbolNormalizer)
         """
-        super(DtraceCollapser, self).__init__(input_file)
+        super(DtraceCollapser, self).__init__(input_file, normalizer)
 
     def parse(self):
-        """parse(self) -> list[(list[str], int)]
+        """parse(self) -> iterator[(list[str], int)]
         """
-        result = []
+        normalize = self._normalizer.normalize
         stack = []
-        for i, line in enumerate([x.strip() for x in self._input_file], 1):
+        i = 0
+        for i, line in enumerate(self._input_file, 1):
+            line = line.strip()
             if not line:
                 continue
             try:
                 count = int(line)
-                if not stack:
-                    raise StackCollapserException('Found a number at line {} but the stack is empty'.format(i))
-                result.append((stack[::-1], count))
-                stack = []
             except ValueError:
-                stack.append(trim_offset(line))
-
-        return result
+                stack.append(normalize(line))
+                continue
+            if not stack:
+                raise StackCollapserException('Found a number at line {} but the stack is empty'.format(i))
+            yield stack[::-1], count
+            stack = []
+        get_stats().add('lines', i)
+        self._normalizer.report_stats()
@@ -10,28 +10,125 @@ Perf script output example:
     ...
 
 Read more here: https://github.com/brendangregg/FlameGraph/blob/master/stackcollapse-perf.pl
+
+The header line of a sample is 'comm pid[/tid] [cpu] time: [period] event:'. Samples can be
+filtered by any of these fields with SampleFilter. Frame lines of rejected samples are
+skipped without being tokenized. parse_timed() also yields the timestamp of every sample.
 """
 
+import re
 from itertools import takewhile
-from tfg.stackcollapsers.stackcollapser import StackCollapser, StackCollapserException, trim_offset
+from tfg.stackcollapsers.stackcollapser import StackCollapser, StackCollapserException
+from tfg.stats import get_stats
+
+
+# 'comm pid[/tid] [cpu] time: [period] event:'. The comm is everything before the first
+# number, so it can contain spaces.
+_HEADER_RE = re.compile(r'\s*(.*?)\s+(\d+)(?:/(\d+))?(?:\s+\[\d+\])?(?:\s+(\d+\.\d+):)?'
+                        r'(?:\s+\d+)?\s+(\S+?):?(?:\s|$)')
+
+
+class SampleFilter(object):
+    """Accept or reject perf samples by the fields of their header line.
+    A sample is accepted if it matches all given filters. None means no filter.
+
+    comms - command names. Spaces in names are the same as underscores.
+    pids, tids - process and thread ids. If the header has a single id (perf script prints
+        the thread id by default), it's used as both the pid and the tid.
+    events - event names. 'cycles' also matches events with modifiers like 'cycles:u'.
+    start, end - [start, end] range of timestamps in seconds. Samples without a timestamp
+        are rejected.
+    """
+    def __init__(self, comms=None, pids=None, tids=None, events=None, start=None, end=None):
+        """__init__(self, comms: list[str], pids: list[int], tids: list[int],
+                    events: list[str], start: float, end: float)
+        """
+        self.comms = None if comms is None else frozenset(c.replace(' ', '_') for c in comms)
+        self.pids = None if pids is None else frozenset(pids)
+        self.tids = None if tids is None else frozenset(tids)
+        self.events = None if events is None else tuple(events)
+        self.start = start
+        self.end = end
+
+    def params(self):
+        """params(self) -> tuple
+        Return the filters as a tuple that doesn't depend on the order they were given in.
+        Used as a part of the cache key.
+        """
+        return tuple(None if values is None else tuple(sorted(values))
+                     for values in (self.comms, self.pids, self.tids, self.events)) + \
+            (self.start, self.end)
+
+    def accepts(self, header):
+        """accepts(self, header: str) -> bool
+        Return True if the sample with the 'header' line passes all filters.
+        """
+        comm, pid, tid, timestamp, event = parse_header(header)
+        if self.comms is not None and comm not in self.comms:
+            return False
+        if self.pids is not None and pid not in self.pids:
+            return False
+        if self.tids is not None and tid not in self.tids:
+            return False
+        if self.events is not None:
+            if event is None or not any(event == name or event.startswith(name + ':')
+                                        for name in self.events):
+                return False
+        if self.start is not None or self.end is not None:
+            if timestamp is None:
+                return False
+            if self.start is not None and timestamp < self.start:
+                return False
+            if self.end is not None and timestamp > self.end:
+                return False
+        return True
+
 
 class PerfCollapser(StackCollapser):
-    def __init__(self, input_file):
-        """__init__(self, input_file: file)
+    SPLIT_ON_BLANK_LINES = True
+
+    def __init__(self, input_file, normalizer=None, sample_filter=None):
+        """__init__(self, input_file: file, normalizer: SymbolNormalizer,
+                    sample_filter: SampleFilter)
+        sample_filter - if given, samples it rejects are skipped.
         """
-        super(PerfCollapser, self).__init__(input_file)
+        super(PerfCollapser, self).__init__(input_file, normalizer)
+        self._sample_filter = sample_filter
 
     def parse(self):
-        """parse(self) -> list[(list[str], int)]
+        """parse(self) -> iterator[(list[str], int)]
+        """
+        return self._parse(False)
+
+    def parse_timed(self):
+        """parse_timed(self) -> iterator[(float, list[str], int)]
+        Like parse(), but every stack comes with the timestamp of its sample in seconds
+        (None if the header line has no timestamp).
         """
-        result = []
+        return self._parse(True)
+
+    def _parse(self, timed):
+        normalize = self._normalizer.normalize
+        sample_filter = self._sample_filter
         stack = []
         comm = ''
-        for i, line in enumerate([x.strip() for x in self._input_file], 1):
+        timestamp = None
+        # True while frame lines of a rejected sample are read
+        skipping = False
+        rejected = 0
+        i = 0
+        for i, line in enumerate(self._input_file, 1):
+            if skipping:
+                skipping = not line.isspace()
+                continue
+            line = line.strip()
             if not line:
                 if comm: # If line is empty and we have a comm name
                     stack.append(comm)
-                    result.append((stack[::-1], 1))
+                    if timed:
+                        yield timestamp, stack[::-1], 1
+                    else:
+                        yield stack[::-1], 1
                     stack = []
                     comm = ''
                 continue
@@ -41,12 +138,22 @@ class PerfCollapser(StackCollapser):
                 comm = extract_comm(fields)
                 if not comm:
                     raise StackCollapserException('Failed to parse line {}'.format(i))
+                if sample_filter is not None and not sample_filter.accepts(line):
+                    comm = ''
+                    skipping = True
+                    rejected += 1
+                elif timed:
+                    timestamp = parse_header(line)[3]
             else:
                 try:
-                    stack.append(trim_offset(extract_stack_name(fields)))
+                    stack.append(normalize(extract_stack_name(fields)))
                 except IndexError:
                     raise StackCollapserException('Failed to parse line {}'.format(i))
-        return result
+        get_stats().add('lines', i)
+        if sample_filter is not None:
+            get_stats().add('rejected samples', rejected)
+        self._normalizer.report_stats()
+
 
 def extract_comm(fields):
     """_extract_comm(self, fields: list[str]) -> str
@@ -58,6 +165,26 @@ def extract_comm(fields):
     """
     return '_'.join(takewhile(lambda x: not x.isdigit(), fields))
 
+def parse_header(line):
+    """parse_header(line: str) -> (str, int, int, float, str)
+    Return (comm, pid, tid, timestamp, event) of a sample header line. Fields that are not
+    in the header are None. Whitespace in the comm is replaced with underscores.
+
+    Examples:
+        Web Content 123/124 [002] 10.5: 1000 cycles:u:
+            -> ('Web_Content', 123, 124, 10.5, 'cycles:u')
+        init 1 4042688.470566: cpu-clock:
+            -> ('init', 1, 1, 4042688.470566, 'cpu-clock')
+    """
+    match = _HEADER_RE.match(line)
+    if match is None:
+        return '_'.join(line.split()), None, None, None, None
+    comm, pid, tid, timestamp, event = match.groups()
+    pid = int(pid)
+    return ('_'.join(comm.split()), pid, pid if tid is None else int(tid),
+            None if timestamp is None else float(timestamp), event)
+
+
 def extract_stack_name(fields):
     """_extract_stack_name(self, fields: list[str]) -> str
     Extract a stack name from the fields
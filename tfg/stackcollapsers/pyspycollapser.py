@@ -1,16 +1,23 @@
 from tfg.stackcollapsers.stackcollapser import StackCollapser
+from tfg.stats import get_stats
 
 class PySpyCollapser(StackCollapser):
+    # py-spy frames are 'function (file.py:line)' and were never trimmed
+    DEFAULT_STAGES = ()
+
     def parse(self):
-        """parse(self) -> list[(list[str], int)]
+        """parse(self) -> iterator[(list[str], int)]
         """
-        result = []
-        for i, line in enumerate([x.strip() for x in self._input_file], 1):
+        normalize = self._normalizer.normalize
+        i = 0
+        for i, line in enumerate(self._input_file, 1):
+            line = line.strip()
             if not line:
                 continue
             vals = line.split(";")
             parts = vals[-1].split(" ")
             vals[-1] = " ".join(parts[:-1])
             count = int(parts[-1])
-            result.append((vals, count))
-        return result
+            yield list(map(normalize, vals)), count
+        get_stats().add('lines', i)
+        self._normalizer.report_stats()
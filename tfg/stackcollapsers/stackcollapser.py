@@ -1,7 +1,27 @@
 """Basic classes and functions for all stack collapsers.
 """
 
+import os
 import re
+import sys
+from collections import OrderedDict, namedtuple
+from tfg.stats import get_stats
+
+
+# Maximum number of raw symbols SymbolNormalizer remembers
+DEFAULT_CACHE_SIZE = 1 << 18
+
+_OFFSET_RE = re.compile(r'\+0x[0-9a-fA-F]+$')
+# A bare address, optionally with a module prefix: 0x7f3a2c01b2a0, tcsh`0x4485a3
+_JIT_ADDRESS_RE = re.compile(r'(^|`)(?:0x[0-9a-fA-F]+|[0-9a-fA-F]{12,})$')
+_PYTHON_LINE_RE = re.compile(r' \([^()]*:\d+\)$')
+
+try:
+    _intern = sys.intern
+except AttributeError:
+    def _intern(name):
+        # Python 2 can only intern byte strings
+        return intern(name) if isinstance(name, str) else name
 
 
 def trim_offset(name):
@@ -11,7 +31,188 @@ def trim_offset(name):
     Example:
         some_function+0x42beef -> some_function
     """
-    return re.sub(r'\+0x[0-9a-fA-F]+$', '', name)
+    # A substring search is much cheaper than a regex and most names have no offset
+    if '+0x' not in name:
+        return name
+    return _OFFSET_RE.sub('', name)
+
+
+def strip_cpp_args(name):
+    """strip_cpp_args(name: str) -> str
+    Remove the argument list (and qualifiers after it) from a demangled C++ name.
+    Names with a space before the parenthesis (e.g. Python 'function (file.py:1)') are kept.
+
+    Example:
+        ns::Foo::bar(int, std::vector<int> const&) const -> ns::Foo::bar
+    """
+    end = name.rfind(')')
+    if end < 0:
+        return name
+    depth = 0
+    for i in range(end, -1, -1):
+        if name[i] == ')':
+            depth += 1
+        elif name[i] == '(':
+            depth -= 1
+            if depth == 0:
+                if i > 0 and name[i - 1] != ' ':
+                    return name[:i]
+                return name
+    return name
+
+
+def strip_cpp_templates(name):
+    """strip_cpp_templates(name: str) -> str
+    Remove template arguments from a demangled C++ name. Names with unbalanced angle
+    brackets (e.g. 'operator<<') are kept.
+
+    Example:
+        std::vector<int, std::allocator<int> >::push_back -> std::vector::push_back
+    """
+    if '<' not in name:
+        return name
+    parts = []
+    depth = 0
+    start = 0
+    for i, char in enumerate(name):
+        if char == '<':
+            if depth == 0:
+                parts.append(name[start:i])
+            depth += 1
+        elif char == '>':
+            depth -= 1
+            if depth < 0:
+                return name
+            if depth == 0:
+                start = i + 1
+    if depth != 0:
+        return name
+    parts.append(name[start:])
+    return ''.join(parts)
+
+
+def fold_jit_address(name):
+    """fold_jit_address(name: str) -> str
+    Replace a bare address (usually a JIT compiled frame) with '[jit]', so all such frames
+    of a module are folded into one.
+
+    Example:
+        0x00007f3a2c01b2a0 -> [jit]
+        tcsh`0x4485a3 -> tcsh`[jit]
+    """
+    return _JIT_ADDRESS_RE.sub(r'\1[jit]', name)
+
+
+def strip_python_line(name):
+    """strip_python_line(name: str) -> str
+    Remove the file and line number from a Python frame, so all lines of a function are
+    folded into one frame.
+
+    Example:
+        handle_request (server.py:42) -> handle_request
+    """
+    return _PYTHON_LINE_RE.sub('', name)
+
+
+# Normalization stage name -> function. Stages are applied in this order.
+NORMALIZATION_STAGES = OrderedDict([
+    ('offsets', trim_offset),
+    ('jit', fold_jit_address),
+    ('python-lines', strip_python_line),
+    ('cpp-args', strip_cpp_args),
+    ('cpp-templates', strip_cpp_templates),
+])
+DEFAULT_STAGES = ('offsets',)
+
+
+class SymbolNormalizer(object):
+    """Turn raw symbols into frame names with a pipeline of normalization stages (see
+    NORMALIZATION_STAGES). Resulting names are interned.
+
+    The same few thousand symbols show up in millions of samples, so results are
+    memoized in an LRU cache of 'max_size' raw symbols and every distinct symbol is
+    normally normalized only once.
+    """
+    def __init__(self, stages=DEFAULT_STAGES, max_size=DEFAULT_CACHE_SIZE):
+        """__init__(self, stages: iterable[str], max_size: int)
+        stages - names of the stages to apply.
+        """
+        self.stages = tuple(stage for stage in NORMALIZATION_STAGES if stage in stages)
+        self._functions = [NORMALIZATION_STAGES[stage] for stage in self.stages]
+        self._max_size = max_size
+        self.normalize = _lru_cache(max_size)(self.apply)
+        # Cache hits and misses already reported by report_stats()
+        self._reported = (0, 0)
+
+    def __getstate__(self):
+        # The cache is not worth sending to other processes
+        return {'stages': self.stages, 'max_size': self._max_size}
+
+    def __setstate__(self, state):
+        self.__init__(state['stages'], state['max_size'])
+
+    def apply(self, symbol):
+        """apply(self, symbol: str) -> str
+        Normalize 'symbol' bypassing the cache.
+        """
+        if len(self._functions) == 1:
+            # The default case, saves a loop per symbol
+            return _intern(self._functions[0](symbol))
+        for function in self._functions:
+            symbol = function(symbol)
+        return _intern(symbol)
+
+    # normalize(self, symbol: str) -> str
+    #     Return the normalized 'symbol'. Set in __init__().
+
+    def cache_info(self):
+        """cache_info(self) -> (int, int)
+        Return the total number of cache hits and misses.
+        """
+        info = self.normalize.cache_info()
+        return info.hits, info.misses
+
+    def report_stats(self):
+        """Add the cache hits and misses since the last call to the stats (see tfg.stats).
+        """
+        hits, misses = self.cache_info()
+        stats = get_stats()
+        stats.add('symbol cache hits', hits - self._reported[0])
+        stats.add('symbol cache misses', misses - self._reported[1])
+        self._reported = (hits, misses)
+
+
+_CacheInfo = namedtuple('_CacheInfo', 'hits misses maxsize currsize')
+
+
+def _ordered_dict_lru_cache(max_size):
+    """Minimal replacement of functools.lru_cache for Python 2.
+    """
+    def decorator(function):
+        cache = OrderedDict()
+        counters = [0, 0]
+
+        def wrapper(*args):
+            key = args if len(args) > 1 else args[0]
+            result = cache.pop(key, None)
+            if result is None:
+                counters[1] += 1
+                result = function(*args)
+                if len(cache) >= max_size:
+                    cache.popitem(last=False)
+            else:
+                counters[0] += 1
+            cache[key] = result
+            return result
+        wrapper.cache_info = lambda: _CacheInfo(counters[0], counters[1], max_size, len(cache))
+        return wrapper
+    return decorator
+
+
+try:
+    from functools import lru_cache as _lru_cache
+except ImportError:
+    _lru_cache = _ordered_dict_lru_cache
 
 
 class StackCollapserException(Exception):
@@ -23,17 +224,45 @@ class StackCollapserException(Exception):
 class StackCollapser(object):
     """Basic class for all stack collapsers.
 
-    All derived classes should implement a parse(self) -> list[(list[str], int)] function.
+    All derived classes should implement a parse(self) -> iterator[(list[str], int)] function.
+    parse() is a generator: stacks are yielded as soon as they're read from the input file,
+    so the whole input never has to be held in memory.
     StackCollapser can parse already collapsed stack (see parse()). It's useful when you
     already have a file with collapsed stack from previous runs of stackcollapser.
+
+    SPLIT_ON_BLANK_LINES - True if samples span multiple lines and are separated by blank
+        lines. Used to split the input file between several parsers.
+    DEFAULT_STAGES - normalization stages frame names of this input type always go through.
+
+    Every frame name goes through the SymbolNormalizer passed to the constructor as the
+    'normalizer' keyword argument (one with DEFAULT_STAGES of the collapser by default).
+
+    position - number of bytes of the input file read so far. Can be read from another
+        thread while parse() runs to display the progress. It's only known if the input file
+        has a descriptor (e.g. it's a plain file) and is ahead of parsing by the size of the
+        file buffers.
     """
-    def __init__(self, input_file):
-        """__init__(self, input_file: file)
+    SPLIT_ON_BLANK_LINES = False
+    DEFAULT_STAGES = DEFAULT_STAGES
+
+    def __init__(self, input_file, normalizer=None):
+        """__init__(self, input_file: file, normalizer: SymbolNormalizer)
         """
         self._input_file = input_file
+        self._normalizer = normalizer or SymbolNormalizer(self.DEFAULT_STAGES)
+        # The last known position. Kept once the input file is closed.
+        self._position = 0
+
+    @property
+    def position(self):
+        try:
+            self._position = os.lseek(self._input_file.fileno(), 0, os.SEEK_CUR)
+        except (AttributeError, EnvironmentError, ValueError):
+            pass
+        return self._position
 
     def parse(self):
-        """parse(self) -> list[(list[str], int)]
+        """parse(self) -> iterator[(list[str], int)]
         Parse self._input_file. Assume that self._input_file contains already collapsed stack.
 
         Example input:
@@ -41,23 +270,24 @@ class StackCollapser(object):
             kernel`0xffffffff8074d27e;kernel`_sx_xlock_hard 5
             kernel`0xffffffff8074d27e;kernel`fork_exit;if_cxgbe.ko`t4_eth_rx 1
 
-        Example output:
-            [
-                (['kernel`0xffffffff8074d27e', 'kernel`_sx_xlock'], 1),
-                (['kernel`0xffffffff8074d27e', 'kernel`_sx_xlock_hard], 5),
-                (['kernel`0xffffffff8074d27e', 'kernel`fork_exit', 'if_cxgbe.ko`t4_eth_rx'], 1)
-            ]
+        Example output (yielded one by one):
+            (['kernel`0xffffffff8074d27e', 'kernel`_sx_xlock'], 1)
+            (['kernel`0xffffffff8074d27e', 'kernel`_sx_xlock_hard], 5)
+            (['kernel`0xffffffff8074d27e', 'kernel`fork_exit', 'if_cxgbe.ko`t4_eth_rx'], 1)
         """
-        result = list()
-        for i, line in enumerate([x.strip() for x in self._input_file], 1):
+        normalize = self._normalizer.normalize
+        i = 0
+        for i, line in enumerate(self._input_file, 1):
+            line = line.strip()
             if not line:
                 continue
             # There should be only 2 entries. Example:
             # kernel`0xffffffff8074d27e;kernel`_sx_xlock 1
             try:
                 frames, value = line.split()
-                frames = [trim_offset(n) for n in frames.split(';')]
+                frames = list(map(normalize, frames.split(';')))
             except ValueError:
                 raise StackCollapserException('Unable to parse line {}'.format(i))
-            result.append((frames, int(value)))
-        return result
+            yield frames, int(value)
+        get_stats().add('lines', i)
+        self._normalizer.report_stats()
@@ -0,0 +1,209 @@
+"""Phase timing and memory instrumentation (--stats).
+Code that wants to be measured asks for the current Stats with get_stats() and reports
+phases and counters to it:
+
+    with get_stats().phase('freeze'):
+        call_tree = call_tree.freeze()
+    get_stats().add('lines', lines)
+
+Until enable_stats() is called, get_stats() returns NullStats which does nothing, so the
+instrumentation costs nothing when --stats is not used. Phases and counters should only be
+reported a few times per run (never per line or per sample) to keep it that way. Use
+Stats.split() to measure a producer and a consumer of a stream of stacks.
+"""
+
+import sys
+import time
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+_wall_clock = getattr(time, 'perf_counter', time.time)
+try:
+    _cpu_clock = time.process_time
+except AttributeError:
+    # On Python 2 time.clock() returns the processor time on Unix
+    _cpu_clock = time.clock
+
+
+def peak_rss():
+    """peak_rss() -> int
+    Return the peak resident set size of the process in bytes or None if it's unknown.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, everything else reports kilobytes
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class _NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class NullStats(object):
+    """Stats that don't record anything. Used when --stats is not given.
+    """
+    enabled = False
+    _NULL_PHASE = _NullPhase()
+
+    def phase(self, name):
+        return self._NULL_PHASE
+
+    def split(self, iterable, producer, consumer, counter=None):
+        return iterable
+
+    def add(self, name, value):
+        pass
+
+    def set(self, name, value):
+        pass
+
+    def report(self, output_file):
+        pass
+
+
+class _Phase(object):
+    """Context manager that adds the time spent inside it to a phase.
+    """
+    def __init__(self, stats, name):
+        self._stats = stats
+        self._name = name
+        self._wall = 0
+        self._cpu = 0
+
+    def __enter__(self):
+        self._wall = _wall_clock()
+        self._cpu = _cpu_clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stats.add_time(self._name, _wall_clock() - self._wall, _cpu_clock() - self._cpu)
+
+
+class Stats(object):
+    """Wall and CPU time of every phase plus counters (e.g. number of lines or nodes).
+    Phases and counters are reported in the order they were first recorded.
+    """
+    enabled = True
+
+    def __init__(self):
+        # name -> [wall time, cpu time]
+        self._phases = {}
+        self._phases_order = []
+        self._counters = {}
+        self._counters_order = []
+
+    def phase(self, name):
+        """phase(self, name: str) -> context manager
+        Add the time spent inside the 'with' block to the phase 'name'.
+        """
+        return _Phase(self, name)
+
+    def add_time(self, name, wall, cpu):
+        """add_time(self, name: str, wall: float, cpu: float)
+        Add wall and CPU time (in seconds) to the phase 'name'.
+        """
+        times = self._phases.get(name)
+        if times is None:
+            times = self._phases[name] = [0, 0]
+            self._phases_order.append(name)
+        times[0] += wall
+        times[1] += cpu
+
+    def split(self, iterable, producer, consumer, counter=None):
+        """split(self, iterable: iterable, producer: str, consumer: str, counter: str) -> iterator
+        Yield items of 'iterable'. Time spent to get the next item is added to the phase
+        'producer' and time spent between the items (i.e. by the code that uses them)
+        is added to the phase 'consumer'. The number of items is added to the counter
+        'counter' (if given).
+        """
+        producer_wall = producer_cpu = consumer_wall = consumer_cpu = 0
+        items = 0
+        wall = _wall_clock()
+        cpu = _cpu_clock()
+        try:
+            for item in iterable:
+                item_wall = _wall_clock()
+                item_cpu = _cpu_clock()
+                producer_wall += item_wall - wall
+                producer_cpu += item_cpu - cpu
+                items += 1
+                yield item
+                wall = _wall_clock()
+                cpu = _cpu_clock()
+                consumer_wall += wall - item_wall
+                consumer_cpu += cpu - item_cpu
+            producer_wall += _wall_clock() - wall
+            producer_cpu += _cpu_clock() - cpu
+        finally:
+            self.add_time(producer, producer_wall, producer_cpu)
+            self.add_time(consumer, consumer_wall, consumer_cpu)
+            if counter is not None:
+                self.add(counter, items)
+
+    def add(self, name, value):
+        """add(self, name: str, value: int)
+        Add 'value' to the counter 'name'.
+        """
+        if name not in self._counters:
+            self._counters[name] = 0
+            self._counters_order.append(name)
+        self._counters[name] += value
+
+    def set(self, name, value):
+        """set(self, name: str, value: int)
+        Set the counter 'name' to 'value'.
+        """
+        if name not in self._counters:
+            self._counters_order.append(name)
+        self._counters[name] = value
+
+    def report(self, output_file):
+        """report(self, output_file: file)
+        Write all phases, counters and the peak RSS to 'output_file'.
+        """
+        output_file.write('{:<24} {:>10} {:>10}\n'.format('phase', 'wall, s', 'cpu, s'))
+        for name in self._phases_order:
+            wall, cpu = self._phases[name]
+            output_file.write('{:<24} {:>10.3f} {:>10.3f}\n'.format(name, wall, cpu))
+        output_file.write('\n')
+        for name in self._counters_order:
+            output_file.write('{:<24} {:>21}\n'.format(name, self._counters[name]))
+        lines = self._counters.get('lines')
+        parse_time = self._phases.get('parse')
+        if lines and parse_time and parse_time[0] > 0:
+            output_file.write('{:<24} {:>21.0f}\n'.format('lines per second', lines / parse_time[0]))
+        hits = self._counters.get('symbol cache hits', 0)
+        lookups = hits + self._counters.get('symbol cache misses', 0)
+        if lookups:
+            output_file.write('{:<24} {:>20.1f}%\n'.format('symbol cache hit rate',
+                                                          hits * 100.0 / lookups))
+        rss = peak_rss()
+        if rss is not None:
+            output_file.write('{:<24} {:>17.1f} MiB\n'.format('peak RSS', rss / float(1 << 20)))
+
+
+_stats = NullStats()
+
+
+def get_stats():
+    """get_stats() -> Stats | NullStats
+    Return the current stats. NullStats if enable_stats() wasn't called.
+    """
+    return _stats
+
+
+def enable_stats():
+    """enable_stats() -> Stats
+    Start recording stats.
+    """
+    global _stats
+    _stats = Stats()
+    return _stats